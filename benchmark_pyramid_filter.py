@@ -0,0 +1,99 @@
+"""
+Benchmark of the multi-resolution (pyramid) Perona-Malik filter against the
+single-level filter on a synthetic DEM. Reports run time and the difference
+between the two filtered surfaces, also relative to the change the
+single-level filter makes to the DEM. A level is accepted when that relative
+RMSE is at most --max-rel-rmse (default 0.15), the relative RMSE over the
+edge cells (DEM gradient above kappa, which the filter must preserve) is at
+most --max-edge-rel-rmse (default 0.2) and, if --max-abs-diff is given, no
+cell differs by more than that; the exit status is 1 if any level is not.
+The RMSE criteria do not bound single cells: the largest difference is 2-3
+times the RMS change the single-level filter makes.
+
+    python benchmark_pyramid_filter.py --size 2000 --niter 50 --levels 1 2 3
+"""
+import argparse
+import sys
+import time
+import numpy as np
+from pygeonet_nonlinear_filter import anisodiff, anisodiff_pyramid
+
+
+def synthetic_dem(nrows, ncols, seed=0):
+    # Smooth hillslopes with incised valleys and some pixel scale noise
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:nrows, 0:ncols].astype('float32')
+    dem = 0.05*y + 20*np.sin(x/150.)*np.cos(y/200.)
+    dem -= 8*np.exp(-((x % 300)-150)**2/200.)
+    dem += rng.normal(scale=0.5, size=dem.shape)
+    return dem.astype('float32')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=1000,
+                        help='Synthetic DEM is size x size pixels')
+    parser.add_argument('--niter', type=int, default=50)
+    parser.add_argument('--kappa', type=float, default=0.5)
+    parser.add_argument('--gamma', type=float, default=0.1)
+    parser.add_argument('--option', type=int, default=2, choices=(1, 2))
+    parser.add_argument('--engine', default='numpy',
+                        choices=('numpy', 'numba', 'multiprocess'))
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--fine-iterations', type=int, default=20)
+    parser.add_argument('--max-rel-rmse', type=float, default=0.15,
+                        help='Acceptance threshold of the relative RMSE')
+    parser.add_argument('--max-edge-rel-rmse', type=float, default=0.2,
+                        help='Acceptance threshold of the relative RMSE '
+                        'over the edge cells')
+    parser.add_argument('--max-abs-diff', type=float, default=None,
+                        help='Acceptance threshold of the largest '
+                        'difference of any cell (DEM units)')
+    args = parser.parse_args()
+
+    dem = synthetic_dem(args.size, args.size)
+    start = time.perf_counter()
+    reference = anisodiff(dem, args.niter, args.kappa, args.gamma,
+                          option=args.option, engine=args.engine)
+    referenceTime = time.perf_counter() - start
+    referenceChange = np.sqrt(np.mean((reference-dem)**2))
+    # edge cells: gradient above kappa, where the filter stops diffusing
+    gradY, gradX = np.gradient(dem)
+    edges = np.hypot(gradX, gradY) > args.kappa
+    print('single level: %.2f s, rms change of DEM %.4f, %.1f%% edge cells'
+          % (referenceTime, referenceChange, 100*np.mean(edges)))
+    print('%6s %9s %8s %10s %10s %10s %10s %10s %8s'
+          % ('levels', 'time (s)', 'speedup', 'rmse', 'max diff',
+             'rel rmse', 'edge rel', 'edge max', 'accepted'))
+    accepted = True
+    for levels in args.levels:
+        start = time.perf_counter()
+        filtered = anisodiff_pyramid(dem, args.niter, args.kappa, args.gamma,
+                                     option=args.option, engine=args.engine,
+                                     levels=levels,
+                                     fineIterations=args.fine_iterations)
+        elapsed = time.perf_counter() - start
+        difference = np.abs(filtered - reference)
+        rmse = np.sqrt(np.mean(difference**2))
+        maxDiff = np.max(difference)
+        edgeRmse = np.sqrt(np.mean(difference[edges]**2)) if edges.any() \
+            else 0.
+        edgeMax = np.max(difference[edges], initial=0.)
+        ok = rmse/referenceChange <= args.max_rel_rmse and \
+            edgeRmse/referenceChange <= args.max_edge_rel_rmse and \
+            (args.max_abs_diff is None or maxDiff <= args.max_abs_diff)
+        accepted &= ok
+        print('%6d %9.2f %8.2f %10.4f %10.4f %10.4f %10.4f %10.4f %8s'
+              % (levels, elapsed, referenceTime/elapsed, rmse, maxDiff,
+                 rmse/referenceChange, edgeRmse/referenceChange, edgeMax,
+                 'yes' if ok else 'no'))
+    print('thresholds: relative rmse %.2f, edge relative rmse %.2f, max'
+          ' difference %s: %s' % (
+              args.max_rel_rmse, args.max_edge_rel_rmse,
+              'none' if args.max_abs_diff is None else args.max_abs_diff,
+              'accepted' if accepted else 'NOT accepted'))
+    return 0 if accepted else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""
+Benchmark of the quantile-quantile curvature threshold estimators on a
+synthetic curvature grid: normally distributed hillslope curvature with a
+heavy positive tail of channelized cells. The deviation point from all
+cells is compared with the stratified subsample and binned CDF
+estimators.
+
+    python benchmark_qq_estimation.py --size 4000 --fraction 0.01
+"""
+import argparse
+import time
+import numpy as np
+from pygeonet_statistics import (qq_deviation_point, curvature_qq_threshold,
+                                 stratified_subsample)
+
+
+def synthetic_curvature(nrows, ncols, channelFraction=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    curvature = rng.normal(0., 0.2, size=(nrows, ncols)).astype('float32')
+    channels = rng.random((nrows, ncols)) < channelFraction
+    curvature[channels] += rng.exponential(1., size=channels.sum())
+    # some nodata around the edges, as from a clipped DEM
+    curvature[:, :ncols//50] = np.nan
+    return curvature
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=int, default=3000,
+                        help='Synthetic grid is size x size cells')
+    parser.add_argument('--fraction', type=float, nargs='+',
+                        default=[0.01, 0.001],
+                        help='Subsample fractions to test')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='Subsample seeds per fraction')
+    args = parser.parse_args()
+
+    curvature = synthetic_curvature(args.size, args.size)
+    start = time.perf_counter()
+    values = curvature[np.isfinite(curvature)].astype('float64')
+    probs = (np.arange(1000)+0.5)/1000
+    reference = qq_deviation_point(probs, np.quantile(values, probs),
+                                   values.mean(), values.std(),
+                                   tolerance=args.tolerance)
+    referenceTime = time.perf_counter() - start
+    print('all %d cells: threshold %.4f std, %.2f s'
+          % (values.size, reference, referenceTime))
+    del values
+
+    start = time.perf_counter()
+    binned = curvature_qq_threshold(curvature, 'binned',
+                                    tolerance=args.tolerance)
+    print('binned CDF: threshold %.4f std (error %+.4f), %.2f s'
+          % (binned, binned-reference, time.perf_counter()-start))
+
+    for fraction in args.fraction:
+        thresholds = []
+        start = time.perf_counter()
+        for seed in range(args.repeats):
+            sample = stratified_subsample(curvature, fraction, seed=seed)
+            thresholds.append(qq_deviation_point(
+                probs, np.quantile(sample, probs), sample.mean(),
+                sample.std(), tolerance=args.tolerance))
+        elapsed = (time.perf_counter()-start)/args.repeats
+        thresholds = np.array(thresholds)
+        print('%g subsample: threshold %.4f +- %.4f std (max error %.4f),'
+              ' %.2f s' % (fraction, thresholds.mean(), thresholds.std(),
+                           np.max(np.abs(thresholds-reference)), elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,9 @@
 import numpy as np
 import time
 from scipy import ndimage
-from time import clock
 from pygeonet_rasterio import *
 from pygeonet_vectorio import *
 from pygeonet_plot import *
-from numba import jit
 
 def Channel_Head_Definition(skeletonFromFlowAndCurvatureArray, geodesicDistanceArray):
     # Locating end points
@@ -95,10 +93,10 @@ def Channel_Head_Definition(skeletonFromFlowAndCurvatureArray, geodesicDistanceA
     skeletonEndPointsListArray = np.transpose(skeletonEndPointsList)
     if defaults.doPlot == 1:
         raster_point_plot(skeletonFromFlowAndCurvatureArray, skeletonEndPointsListArray,
-                          'Skeleton Num elements Array with channel heads', cm.binary, 'ro')
+                          'Skeleton Num elements Array with channel heads', 'binary', 'ro')
     if defaults.doPlot == 1:
         raster_point_plot(geodesicDistanceArray, skeletonEndPointsListArray,
-                          'Geodesic distance Array with channel heads', cm.coolwarm, 'ro')
+                          'Geodesic distance Array with channel heads', 'coolwarm', 'ro')
     xx = skeletonEndPointsListArray[1]
     yy = skeletonEndPointsListArray[0]
     # Write shapefiles of channel heads
@@ -111,17 +109,17 @@ def Channel_Head_Definition(skeletonFromFlowAndCurvatureArray, geodesicDistanceA
     outfilepath = Parameters.geonetResultsDir
     demName = Parameters.demFileName
     outfilename = demName.split('.')[0]+'_channelHeads.tif'
-    write_geotif_generic(channelheadArray,\
-                         outfilepath,outfilename)
+    write_stage_output(channelheadArray,\
+                       outfilepath,outfilename)
     return xx, yy
 
 def main():
     outfilepath = Parameters.geonetResultsDir
     demName = Parameters.demFileName.split('.')[0]
     skeleton_filename = demName+'_skeleton.tif'
-    skeletonFromFlowAndCurvatureArray = read_geotif_generic(outfilepath, skeleton_filename)[0]
+    skeletonFromFlowAndCurvatureArray = read_stage_output(outfilepath, skeleton_filename)
     geodesic_filename = demName+'_geodesicDistance.tif'
-    geodesicDistanceArray = read_geotif_generic(outfilepath, geodesic_filename)[0]
+    geodesicDistanceArray = read_stage_output(outfilepath, geodesic_filename)
     Channel_Head_Definition(skeletonFromFlowAndCurvatureArray, geodesicDistanceArray)
 
 
@@ -16,15 +16,59 @@ doResetFiguresOnStart = 1
 
 
 # **** Default Parameters for Perona-Malik nonlinear diffusion
-# ... could be:  PeronaMalik1, PeronaMalik2, Tukey, rampPreserving
+# ... could be:  PeronaMalik1, PeronaMalik2, PeronaMalikAOS, Gaussian,
+# Tukey, rampPreserving
+# PeronaMalikAOS is a semi-implicit PeronaMalik2 solver reaching the same
+# diffusion time (nFilterIterations*diffusionTimeIncrement) in steps of
+# aosTimeIncrement
 
 #diffusionMethod = 'PeronaMalik1'
 diffusionMethod = 'PeronaMalik2'
 
+# Engine used to run the Perona-Malik iterations
+# ... could be: numpy, numba, multiprocess
+diffusionEngine = 'numpy'
+nFilterWorkers = 0 # processes for the multiprocess engine, 0 = all cores
 
 diffusionTimeIncrement = 0.1  # this makes the explicit scheme stable
+aosTimeIncrement = 1.0  # the semi-implicit scheme is stable for any step
 diffusionSigmaSquared = 0.05
+# Gaussian smoothing with variance diffusionSigmaSquared, used by the
+# Gaussian diffusionMethod and as an optional pre-smoother of the DEM
+gaussianKernelWidth = 5 # odd
+doGaussianPreSmoothing = 0
 nFilterIterations =  50 # Nonlinear filtering iterations
+# Multi-resolution filtering: run the first iterations on a grid
+# 2**filterPyramidLevels coarser (0 = single level), then
+# filterPyramidFineIterations at full resolution. It approximates the
+# single-level filter only as well as the fine iterations allow: in
+# benchmark_pyramid_filter.py (1000 x 1000, 50 iterations, 1-3 levels) the
+# RMS difference to it is 6-12% of the change the filter makes with 20 fine
+# iterations (1.4-2x faster), but 50-60% with 5 (2.5-6x faster). That is
+# not a bound on single cells: a few differ by 2-3 times that change (over
+# 1 m on the benchmark DEM), so don't use it where pointwise accuracy at
+# full resolution matters
+filterPyramidLevels = 0
+filterPyramidFineIterations = 20
+# Stop filtering early once the residual, the 'max' or 'rms' update of
+# one iteration over valid cells, is below the tolerance (0 = never).
+# Residuals are logged to <dem>_filter_residuals.csv when doFilterResidualLog
+# is 1 (it costs residual temporaries every iteration, so it is off by
+# default)
+filterConvergenceTolerance = 0
+filterResidualMetric = 'max'
+doFilterResidualLog = 0
+# Checkpoint the in-memory Perona-Malik filter every filterCheckpointInterval
+# iterations to memory-mapped files in the results directory, and resume
+# from them after a crash (0 = no checkpoints)
+filterCheckpointInterval = 0
+
+# Out-of-core filtering: tile edge in pixels (0 filters the whole DEM in
+# memory). Each tiling pass runs filterHaloIterations iterations with a
+# halo as wide; 0 runs all iterations in one pass with an nFilterIterations
+# halo.
+filterTileSize = 0
+filterHaloIterations = 0
 
 # Flow routing options and sub basin indexing
 thresholdAreaSubBasinIndexing = 1500 # default = 1500
@@ -64,9 +108,72 @@ demErrorFlag = -9998.0
 # (1-demSmoothingQuantile) is the quantile of landscape we want to enhance.
 # A good range of demSmoothingQuantile is 0.5 to 0.9
 demSmoothingQuantile = 0.9 # default = 0.9
+# How that quantile of the slope is computed
+# ... could be: mquantiles (in memory; the tiled mode gets the same value
+# by twopass), sketch (fixed-memory histogram,
+# accurate to one bin width), twopass (exact, histogram then a pass over
+# the bins around the quantile)
+lambdaQuantileMethod = 'mquantiles'
+# ... could be: geometric, laplacian, or profile, plan, tangential (from
+# second derivatives cached in the results directory)
 #curvatureCalcMethod = 'laplacian'
 curvatureCalcMethod = 'geometric'
+# Block edge in pixels for computing slope and curvature block by block,
+# streamed to the output geotiffs (0 = whole DEM in memory)
+slopeCurvatureBlockSize = 0
+# Run the slope/curvature and skeleton stages on lazy dask arrays of about
+# daskChunkSize x daskChunkSize pixels, on a local threaded cluster with
+# daskThreads threads (0 = all cores), writing the outputs chunk by chunk
+useDask = 0
+daskChunkSize = 4096
+daskThreads = 0
+# Write <raster>.stats.json sidecars with precomputed statistics (valid
+# count, mean, std, min, max and these exact percentiles) next to the stage
+# outputs, so later stages don't recompute them
+doStatisticsSidecar = 1
+statisticsSidecarPercentiles = [0.1, 1, 50, 99, 99.9]
+# Hand intermediate rasters between stages as uncompressed <name>.npy plus
+# <name>.json georeference in the results directory, memory-mapped by the
+# next stage. doGeotiffExport = 0 skips the GeoTIFF copies of those outputs
+useArtifactStore = 0
+doGeotiffExport = 1
+# GeoTIFF layout of all outputs: tiled in geotiffBlockSize blocks,
+# compressed with NONE, DEFLATE, ZSTD, LZW or LERC/LERC_DEFLATE/LERC_ZSTD
+# (max error geotiffLercMaxZError, 0 = lossless) on geotiffNumThreads
+# threads. geotiffCog = 1 writes cloud optimized geotiffs with overviews
+# (GDAL >= 3.1). BIGTIFF could be: YES, NO, IF_NEEDED, IF_SAFER
+geotiffTiled = 1
+geotiffBlockSize = 512
+geotiffCompression = 'DEFLATE'
+geotiffLercMaxZError = 0
+geotiffNumThreads = 'ALL_CPUS'
+geotiffBigTiff = 'IF_SAFER'
+geotiffCog = 0
+# Write each output in the narrowest data type that holds it: 1 bit for
+# masks such as the skeletons, Byte/UInt32/Int32 for whole numbers without
+# NaN, Float32 otherwise. 0 = Float32, and Int16 for skeletons
+compactOutputDataTypes = 1
+# Number of files whose read-only GDAL datasets (with their georeference,
+# block size and nodata; one per reading thread) are kept open between
+# reads of the same unchanged file
+datasetCacheSize = 16
+# Threads writing stage outputs in the background while the stage goes on
+# computing (0 = write in the stage's own thread)
+backgroundWriteThreads = 2
+# Threads reading whole rasters in parallel block-aligned strips
+# (0 = GDAL_NUM_THREADS, or all CPUs if it is unset; 1 = a single read)
+rasterReadThreads = 0
 thresholdQqCurvature = 0
+# Curvature threshold of the skeleton, in standard deviations above the
+# mean curvature: 'fixed' uses thresholdCurvatureQQxx, 'subsample' and
+# 'binned' take the point where the curvature quantile-quantile curve
+# deviates from the normal line by more than qqDeviationTolerance,
+# estimated from a stratified qqSampleFraction subsample or from the
+# binned CDF of all cells (thresholdCurvatureQQxx if there is none)
+qqCurvatureEstimator = 'fixed'
+thresholdCurvatureQQxx = 1.5
+qqSampleFraction = 0.01
+qqDeviationTolerance = 0.1
 flowThresholdForSkeleton = 3000 # default = 3000
 channelheadPredefined = 0
 
@@ -0,0 +1,323 @@
+from __future__ import division
+import os
+import json
+import threading
+import types
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+# Derivatives of a DEM with the stencils of np.gradient: central
+# differences inside, one-sided differences on the first and last
+# row/column. All kernels write into caller supplied buffers of an
+# explicit dtype, so repeated calls allocate nothing.
+
+
+# numba is imported, and the kernels compiled, on first use rather than
+# when a stage imports the module: numba_kernel marks a function with its
+# njit options, and jit_kernels swaps all marked functions of a module for
+# their njit versions before any of them runs. Until then prange is range.
+prange = range
+kernelsCompiled = False
+jitLock = threading.Lock()
+
+
+def numba_kernel(**options):
+    def mark(function):
+        function.njitOptions = dict(options, cache=True)
+        return function
+    return mark
+
+
+def jit_kernels(namespace):
+    with jitLock:
+        if namespace['kernelsCompiled']:
+            return
+        from numba import njit, prange
+        for name, value in list(namespace.items()):
+            if isinstance(value, types.FunctionType) and \
+                    'njitOptions' in vars(value) and \
+                    value.__module__ == namespace['__name__']:
+                namespace[name] = njit(**value.njitOptions)(value)
+        namespace['prange'] = prange
+        namespace['kernelsCompiled'] = True
+
+
+@numba_kernel()
+def difference_x(a, i, j, h):
+    ncols = a.shape[1]
+    if j == 0:
+        return (a[i, 1] - a[i, 0])/h
+    if j == ncols-1:
+        return (a[i, ncols-1] - a[i, ncols-2])/h
+    return (a[i, j+1] - a[i, j-1])/(2.*h)
+
+
+@numba_kernel()
+def difference_y(a, i, j, h):
+    nrows = a.shape[0]
+    if i == 0:
+        return (a[1, j] - a[0, j])/h
+    if i == nrows-1:
+        return (a[nrows-1, j] - a[nrows-2, j])/h
+    return (a[i+1, j] - a[i-1, j])/(2.*h)
+
+
+# Gradient divided by its magnitude. Flat cells give NaN like the 0/0 of
+# np.divide, but without the floating point division by zero.
+@numba_kernel()
+def unit_gradient(g, slope, i, j):
+    if slope[i, j] > 0.:
+        return g[i, j]/slope[i, j]
+    return np.nan
+
+
+@numba_kernel(parallel=True)
+def gradient_kernel(dem, h, gradX, gradY, slope):
+    nrows, ncols = dem.shape
+    for i in prange(nrows):
+        for j in range(ncols):
+            gx = difference_x(dem, i, j, h)
+            gy = difference_y(dem, i, j, h)
+            gradX[i, j] = gx
+            gradY[i, j] = gy
+            slope[i, j] = np.sqrt(gx*gx + gy*gy)
+
+
+# Second stencil pass over the first derivatives of gradient_kernel:
+# divergence of the unit gradient (geometric curvature) and of the
+# gradient (laplacian curvature), fused in one loop
+@numba_kernel(parallel=True)
+def curvature_kernel(gradX, gradY, slope, h, geometric, laplacian):
+    nrows, ncols = slope.shape
+    for i in prange(nrows):
+        for j in range(ncols):
+            laplacian[i, j] = (difference_x(gradX, i, j, h) +
+                               difference_y(gradY, i, j, h))
+            if j == 0:
+                jl, jr, hx = 0, 1, h
+            elif j == ncols-1:
+                jl, jr, hx = ncols-2, ncols-1, h
+            else:
+                jl, jr, hx = j-1, j+1, 2.*h
+            if i == 0:
+                iu, idn, hy = 0, 1, h
+            elif i == nrows-1:
+                iu, idn, hy = nrows-2, nrows-1, h
+            else:
+                iu, idn, hy = i-1, i+1, 2.*h
+            geometric[i, j] = (
+                (unit_gradient(gradX, slope, i, jr) -
+                 unit_gradient(gradX, slope, i, jl))/hx +
+                (unit_gradient(gradY, slope, idn, j) -
+                 unit_gradient(gradY, slope, iu, j))/hy)
+
+
+@numba_kernel(parallel=True)
+def second_derivative_kernel(dem, h, zx, zy, zxx, zyy, zxy):
+    nrows, ncols = dem.shape
+    for i in prange(nrows):
+        for j in range(ncols):
+            zx[i, j] = difference_x(dem, i, j, h)
+            zy[i, j] = difference_y(dem, i, j, h)
+    for i in prange(nrows):
+        for j in range(ncols):
+            zxx[i, j] = difference_x(zx, i, j, h)
+            zyy[i, j] = difference_y(zy, i, j, h)
+            zxy[i, j] = difference_y(zx, i, j, h)
+
+
+# Curvatures of the surface from its first and second derivatives, with
+# the sign convention of the geometric curvature: positive where the
+# surface is concave (valleys, hollows). kind 0 is profile curvature
+# (along the slope), 1 plan curvature (of the contours, equal to the
+# geometric curvature in the continuum) and 2 tangential curvature.
+# Flat and nodata cells give NaN.
+@numba_kernel(parallel=True)
+def surface_curvature_kernel(zx, zy, zxx, zyy, zxy, kind, out):
+    nrows, ncols = zx.shape
+    for i in prange(nrows):
+        for j in range(ncols):
+            p = zx[i, j]
+            q = zy[i, j]
+            g2 = p*p + q*q
+            if not g2 > 0.:
+                out[i, j] = np.nan
+            elif kind == 0:
+                out[i, j] = ((zxx[i, j]*p*p + 2.*zxy[i, j]*p*q +
+                              zyy[i, j]*q*q)/(g2*(1.+g2)**1.5))
+            elif kind == 1:
+                out[i, j] = ((zxx[i, j]*q*q - 2.*zxy[i, j]*p*q +
+                              zyy[i, j]*p*p)/g2**1.5)
+            else:
+                out[i, j] = ((zxx[i, j]*q*q - 2.*zxy[i, j]*p*q +
+                              zyy[i, j]*p*p)/(g2*np.sqrt(1.+g2)))
+
+
+SURFACE_CURVATURES = ('profile', 'plan', 'tangential')
+
+
+def derivative_buffers(shape, n, dtype='float32', buffers=None):
+    # reuse the given buffers if they fit, allocate otherwise
+    if buffers is not None:
+        buffers = tuple(buffers)
+        if len(buffers) != n or any(b.shape != tuple(shape) or
+                                    b.dtype != np.dtype(dtype)
+                                    for b in buffers):
+            raise ValueError('derivative buffers must be %d arrays of'
+                             ' shape %s and dtype %s' % (n, shape, dtype))
+        return buffers
+    return tuple(np.empty(shape, dtype=dtype) for _ in range(n))
+
+
+def check_derivative_input(demArray):
+    if demArray.ndim != 2 or min(demArray.shape) < 2:
+        raise ValueError('derivatives need a 2D array with at least two'
+                         ' rows and columns, got shape %s'
+                         % (demArray.shape,))
+
+
+def slope_magnitude(demArray, pixelDemScale, dtype='float32', out=None,
+                    work=None):
+    # Magnitude of np.gradient(demArray, pixelDemScale). work holds the
+    # two gradient components and is returned filled in
+    check_derivative_input(demArray)
+    jit_kernels(globals())
+    slope, = derivative_buffers(demArray.shape, 1, dtype,
+                                None if out is None else (out,))
+    gradX, gradY = derivative_buffers(demArray.shape, 2, dtype, work)
+    gradient_kernel(demArray, float(pixelDemScale), gradX, gradY, slope)
+    return slope
+
+
+def dem_derivatives(demArray, pixelDemScale, dtype='float32', out=None,
+                    work=None):
+    # Slope, geometric and laplacian curvature of demArray in one call.
+    # out: (slope, geometric, laplacian) buffers, work: (gradX, gradY)
+    # buffers, both of shape demArray.shape and the given dtype. Matches
+    # np.gradient based computations, with NaN where they give NaN.
+    check_derivative_input(demArray)
+    jit_kernels(globals())
+    slope, geometric, laplacian = derivative_buffers(demArray.shape, 3,
+                                                     dtype, out)
+    gradX, gradY = derivative_buffers(demArray.shape, 2, dtype, work)
+    h = float(pixelDemScale)
+    gradient_kernel(demArray, h, gradX, gradY, slope)
+    curvature_kernel(gradX, gradY, slope, h, geometric, laplacian)
+    return slope, geometric, laplacian
+
+
+def second_derivatives(demArray, pixelDemScale, dtype='float32', out=None):
+    # (zx, zy, zxx, zyy, zxy) by repeated np.gradient stencils, so that
+    # zxx + zyy is the laplacian curvature of dem_derivatives
+    check_derivative_input(demArray)
+    jit_kernels(globals())
+    out = derivative_buffers(demArray.shape, 5, dtype, out)
+    second_derivative_kernel(demArray, float(pixelDemScale), *out)
+    return out
+
+
+def surface_curvature(derivatives, method, out=None):
+    # profile, plan or tangential curvature from second_derivatives
+    if method not in SURFACE_CURVATURES:
+        raise ValueError('unknown curvature ' + str(method))
+    jit_kernels(globals())
+    zx = derivatives[0]
+    out, = derivative_buffers(zx.shape, 1, zx.dtype,
+                              None if out is None else (out,))
+    surface_curvature_kernel(*derivatives, SURFACE_CURVATURES.index(method),
+                             out)
+    return out
+
+
+def dem_curvature(demArray, pixelDemScale, method):
+    # one curvature type of demArray, NaN where undefined; the unit of work
+    # for dask chunks (it needs a 2 pixel halo)
+    if method in SURFACE_CURVATURES:
+        return surface_curvature(second_derivatives(demArray, pixelDemScale),
+                                 method)
+    slope, geometric, laplacian = dem_derivatives(demArray, pixelDemScale)
+    return geometric if method == 'geometric' else laplacian
+
+
+class DerivativeCache(object):
+    """
+    First and second derivatives of a filtered DEM kept on disk as float32
+    .npy files (<cachePath>_zx.npy, ...) and memory-mapped on use, with
+    <cachePath>.json recording the DEM file's mtime and size, the shape and
+    the pixel scale. They are computed once per filtered DEM; curvature
+    variants are then a cheap combination of the cached derivatives.
+    """
+    names = ('zx', 'zy', 'zxx', 'zyy', 'zxy')
+
+    def __init__(self, cachePath, sourceFileName):
+        self.cachePath = cachePath
+        self.sourceFileName = sourceFileName
+        self.metaFileName = cachePath + '.json'
+        self.arrays = None
+
+    def file_name(self, name):
+        return '%s_%s.npy' % (self.cachePath, name)
+
+    def meta(self, shape, pixelDemScale):
+        stat = os.stat(self.sourceFileName)
+        return {'source': [stat.st_mtime_ns, stat.st_size],
+                'shape': list(shape), 'pixelDemScale': float(pixelDemScale)}
+
+    def is_fresh(self, shape, pixelDemScale):
+        if not os.path.isfile(self.metaFileName) or not all(
+                os.path.isfile(self.file_name(name)) for name in self.names):
+            return False
+        with open(self.metaFileName) as f:
+            return json.load(f) == self.meta(shape, pixelDemScale)
+
+    def update(self, demArray, pixelDemScale):
+        # compute the derivatives unless the cache matches the DEM file
+        if self.is_fresh(demArray.shape, pixelDemScale):
+            print('using cached DEM derivatives')
+            return
+        print('computing DEM derivatives')
+        # the metadata goes last, an interrupted update is never fresh
+        if os.path.isfile(self.metaFileName):
+            os.remove(self.metaFileName)
+        self.arrays = None
+        arrays = [open_memmap(self.file_name(name), mode='w+',
+                              dtype='float32', shape=demArray.shape)
+                  for name in self.names]
+        second_derivatives(demArray, pixelDemScale, out=arrays)
+        for array in arrays:
+            array.flush()
+        del arrays
+        meta = self.meta(demArray.shape, pixelDemScale)
+        with open(self.metaFileName + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.metaFileName + '.tmp', self.metaFileName)
+
+    def derivatives(self):
+        if self.arrays is None:
+            self.arrays = tuple(np.load(self.file_name(name), mmap_mode='r')
+                                for name in self.names)
+        return self.arrays
+
+    def slope(self, out=None):
+        zx, zy = self.derivatives()[:2]
+        return np.hypot(zx, zy, out=out)
+
+    def curvature(self, method, out=None):
+        if method == 'laplacian':
+            zxx, zyy = self.derivatives()[2:4]
+            return np.add(zxx, zyy, out=out)
+        if method == 'geometric':
+            # the second stencil pass of dem_derivatives over the cached
+            # first derivatives, which are those of gradient_kernel
+            jit_kernels(globals())
+            zx, zy = self.derivatives()[:2]
+            with open(self.metaFileName) as f:
+                pixelDemScale = json.load(f)['pixelDemScale']
+            out, = derivative_buffers(zx.shape, 1, zx.dtype,
+                                      None if out is None else (out,))
+            laplacian, = derivative_buffers(zx.shape, 1, zx.dtype)
+            curvature_kernel(zx, zy, self.slope(), float(pixelDemScale), out,
+                             laplacian)
+            return out
+        return surface_curvature(self.derivatives(), method, out)
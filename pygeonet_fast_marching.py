@@ -4,10 +4,6 @@ from time import perf_counter
 from pygeonet_rasterio import *
 from pygeonet_plot import *
 import time
-from numba import njit, prange, set_num_threads
-import psutil
-import dask
-from dask.distributed import Client
 
 def Fast_March_Setup(outlet_array, basinIndexArray):
     print("Setting up Fast Marching Method")
@@ -43,21 +39,40 @@ def Fast_March_Setup(outlet_array, basinIndexArray):
     print("Fast March Setup complete")
     return fastMarchingStartPointList, nDempixels, basin_elements, threshold, iter_total
 
-set_num_threads(12)  # Adjust based on your CPU
-@njit(parallel=True)
+# numba kernel of Fast_Marching_Start_Point_Identification, compiled on
+# first use so that importing this module doesn't load numba
+startPointKernel = None
+
+
+def start_point_kernel():
+    global startPointKernel
+    if startPointKernel is not None:
+        return startPointKernel
+    from numba import njit, prange, set_num_threads, config
+    set_num_threads(min(12, config.NUMBA_NUM_THREADS))  # Adjust based on your CPU
+
+    @njit(parallel=True)
+    def kernel(outlet_array, basinIndexArray,fastMarchingStartPointList, nDempixels,basin_elements, threshold, iter_total):
+        fmmX = []
+        fmmY = []
+        for label in prange(iter_total):
+            #print(np.sum(basinIndexArray.ravel()==(label+1)))
+            numelments = np.sum(basinIndexArray.ravel()==(label+1))
+            
+            percentBasinArea = numelments * 100.00001/nDempixels
+            if (percentBasinArea > threshold) and (numelments > basin_elements):            
+                fmmX.append(fastMarchingStartPointList[1,label])
+                fmmY.append(fastMarchingStartPointList[0,label])
+
+        return fmmX, fmmY
+    startPointKernel = kernel
+    return startPointKernel
+
+
 def Fast_Marching_Start_Point_Identification(outlet_array, basinIndexArray,fastMarchingStartPointList, nDempixels,basin_elements, threshold, iter_total):
-    fmmX = []
-    fmmY = []
-    for label in prange(iter_total):
-        #print(np.sum(basinIndexArray.ravel()==(label+1)))
-        numelments = np.sum(basinIndexArray.ravel()==(label+1))
-        
-        percentBasinArea = numelments * 100.00001/nDempixels
-        if (percentBasinArea > threshold) and (numelments > basin_elements):            
-            fmmX.append(fastMarchingStartPointList[1,label])
-            fmmY.append(fastMarchingStartPointList[0,label])
-
-    return fmmX, fmmY
+    return start_point_kernel()(outlet_array, basinIndexArray,
+                                fastMarchingStartPointList, nDempixels,
+                                basin_elements, threshold, iter_total)
 
 def fmm_list_creation(fmmY,fmmX):
     fastMarchingStartPointListFMM = np.array([fmmY,fmmX])
@@ -111,7 +126,8 @@ def Local_Cost_Computation(flowArray, flowMean,
     outfilepath = Parameters.geonetResultsDir
     outfilename = Parameters.demFileName
     outfilename = outfilename.split('.')[0]+'_costfunction.tif'
-    write_geotif_generic(reciprocalLocalCostArray,outfilepath,outfilename)
+    write_stage_output(reciprocalLocalCostArray,outfilepath,outfilename,
+                       background=True)
     return reciprocalLocalCostArray
 
 def Fast_Marching(fastMarchingStartPointListFMM, basinIndexArray, flowArray, reciprocalLocalCostArray):
@@ -147,6 +163,7 @@ def Fast_Marching(fastMarchingStartPointListFMM, basinIndexArray, flowArray, rec
         phi[fastMarchingStartPointListFMM[0,i],
             fastMarchingStartPointListFMM[1,i]] = -1
         del maskedBasinFAC
+        import psutil
         print(f'RAM usage before FMM {i}: {psutil.virtual_memory()}')
         try:
             travelTimearray = skfmm.travel_time(phi, speed, dx=.01)
@@ -177,7 +194,8 @@ def Fast_Marching(fastMarchingStartPointListFMM, basinIndexArray, flowArray, rec
     outfilepath = Parameters.geonetResultsDir
     demName = Parameters.demFileName.split('.')[0]
     outfilename = demName+'_geodesicDistance.tif'
-    write_geotif_generic(geodesicDistanceArray, outfilepath, outfilename)
+    write_stage_output(geodesicDistanceArray, outfilepath, outfilename,
+                       background=True)
     return geodesicDistanceArray
 
 
@@ -186,23 +204,28 @@ def main():
     demName = Parameters.demFileName.split('.')[0]
     outlet_filename = demName+'_outlets.tif'
     print("Reading the outlet array")
-    outlet_array = read_geotif_generic(outfilepath, outlet_filename)[0]
+    outlet_array = read_stage_output(outfilepath, outlet_filename)
     outlet_array = np.transpose(np.argwhere(~np.isnan(outlet_array)))
     basin_filename = demName+'_basins.tif'
     print("Reading the basin array")
-    basinIndexArray = read_geotif_generic(outfilepath, basin_filename)[0]
+    basinIndexArray = read_stage_output(outfilepath, basin_filename)
     curvature_filename = demName+'_curvature.tif'
     print("Reading the curvature array")
-    curvatureDemArray = read_geotif_generic(outfilepath, curvature_filename)[0]
+    curvatureDemArray = read_stage_output(outfilepath, curvature_filename)
     fac_filename = demName + '_fac.tif'
     print("Reading the flow accumulation array")
-    flowArray = read_geotif_generic(outfilepath, fac_filename)[0]
+    flowArray = read_stage_output(outfilepath, fac_filename)
     filteredDemArray = read_geotif_filteredDEM()
+    # a whole-number FAC is read back as integers, which can't hold NaN
+    if flowArray.dtype.kind != 'f':
+        flowArray = flowArray.astype('float64')
     flowArray[np.isnan(filteredDemArray)]=np.nan
-    flowMean = np.mean(flowArray[~np.isnan(flowArray[:])])
+    # sidecar statistics left by the skeleton stage
+    flowMean = stage_statistics(outfilepath, fac_filename,
+                                Parameters.pmGrassGISfileName)['mean']
     skeleton_filename = demName+'_skeleton.tif'
     print("Reading the skeleton array")
-    skeletonFromFlowAndCurvatureArray = read_geotif_generic(outfilepath, skeleton_filename)[0]
+    skeletonFromFlowAndCurvatureArray = read_stage_output(outfilepath, skeleton_filename)
 
     # Initialize Parameters
     fastMarchingStartPointList,nDempixels,basin_elements, threshold, iter_total = Fast_March_Setup(outlet_array, basinIndexArray)
@@ -234,6 +257,7 @@ def main():
     del curvatureDemArray, skeletonFromFlowAndCurvatureArray
     # Compute the geodesic distance using Fast Marching Method
     geodesicDistanceArray = Fast_Marching(fastMarchingStartPointListFMM, basinIndexArray, flowArray, reciprocalLocalCostArray)
+    wait_for_writes()
     
     
 
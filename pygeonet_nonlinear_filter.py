@@ -1,105 +1,734 @@
 from __future__ import division
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from functools import partial
+import json
+import hashlib
 import numpy as np
-import scipy.signal as conv2
 from time import perf_counter 
-from scipy.stats.mstats import mquantiles
+from numpy.lib.format import open_memmap
 from pygeonet_rasterio import *
+from pygeonet_statistics import *
+from pygeonet_derivatives import slope_magnitude, numba_kernel, jit_kernels
 from pygeonet_plot import *
 
 # Gaussian Filter
 def simple_gaussian_smoothing(inputDemArray, kernelWidth,
-                              diffusionSigmaSquared):
+                              diffusionSigmaSquared, method='auto'):
     """
     smoothing input array with gaussian filter
-    Code is vectorized for efficiency Harish Sangireddy
+    The 2D Gaussian is separable, so it is applied as a 1D filter along
+    columns and then rows ('separable'), or by FFT overlap-add convolution
+    ('fft'), which is cheaper for wide kernels; 'auto' picks by width.
+    Edges are padded with the mean of the outer halfKernelWidth
+    rows/columns, and NaN cells are left out of the weighted average
+    instead of spreading over the kernel footprint. kernelWidth must be
+    odd, so the kernel is centred on the cell.
     """
+    if kernelWidth < 1 or kernelWidth % 2 != 1:
+        raise ValueError('gaussian kernelWidth must be a positive odd'
+                         ' integer, got ' + str(kernelWidth))
     [Ny, Nx] = inputDemArray.shape
     halfKernelWidth = int((kernelWidth-1)/2)
-    # Make a ramp array with 5 rows each containing [-2, -1, 0, 1, 2]
+    # Make a ramp array e.g. [-2, -1, 0, 1, 2]
     x = np.linspace(-halfKernelWidth, halfKernelWidth, kernelWidth)
-    y = x
-    xv, yv = np.meshgrid(x, y)
-    gaussianFilter = np.exp(-(
-        xv**2+yv**2)/(2*diffusionSigmaSquared))  # 2D Gaussian
-    gaussianFilter = gaussianFilter/np.sum(gaussianFilter[:])  # Normalize
-    print(inputDemArray[0, 0:halfKernelWidth])
+    gaussianFilter = np.exp(-x**2/(2*diffusionSigmaSquared))  # 1D Gaussian
+    gaussianFilter = gaussianFilter/np.sum(gaussianFilter)  # Normalize
+    if method == 'auto':
+        method = 'fft' if kernelWidth >= 51 else 'separable'
     xL = np.nanmean(inputDemArray[:, 0:halfKernelWidth], axis=1)
-    print(f'xL: {xL}')
     xR = np.nanmean(inputDemArray[:, Nx-halfKernelWidth:Nx], axis=1)
-    print(f'xR: {xR}')
-    part1T = np.vstack((xL, xL))
-    part1 = part1T.T
-    part2T = np.vstack((xR, xR))
-    part2 = part2T.T
+    part1 = np.repeat(xL[:, np.newaxis], halfKernelWidth, axis=1)
+    part2 = np.repeat(xR[:, np.newaxis], halfKernelWidth, axis=1)
     eI = np.hstack((part1, inputDemArray, part2))
     xU = np.nanmean(eI[0:halfKernelWidth, :], axis=0)
     xD = np.nanmean(eI[Ny-halfKernelWidth:Ny, :], axis=0)
-    part3 = np.vstack((xU, xU))
-    part4 = np.vstack((xD, xD))
-    # Generate the expanded DTM array, 4 pixels wider in both x,y directions
+    part3 = np.repeat(xU[np.newaxis, :], halfKernelWidth, axis=0)
+    part4 = np.repeat(xD[np.newaxis, :], halfKernelWidth, axis=0)
+    # Generate the expanded DTM array, kernelWidth-1 pixels wider in both
+    # x,y directions
     eI = np.vstack((part3, eI, part4))
-    # The 'valid' option forces the 2d convolution to clip 2 pixels off
-    # the edges NaNs spread from one pixel to a 5x5 set centered on
-    # the NaN
-    fillvalue = np.nanmean(inputDemArray[:])
-    smoothedDemArray = conv2.convolve2d(eI, gaussianFilter, 'valid')
-    del inputDemArray, eI
+    # Normalized convolution: smooth the data with NaNs zeroed and the
+    # valid-cell mask, and divide. The 'valid' mode clips the padding.
+    validMask = ~np.isnan(eI)
+    eI[~validMask] = 0
+    smoothedDemArray = separable_convolve_valid(eI, gaussianFilter, method)
+    smoothedWeights = separable_convolve_valid(validMask.astype(eI.dtype),
+                                               gaussianFilter, method)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smoothedDemArray /= smoothedWeights
+    smoothedDemArray[np.isnan(inputDemArray)] = np.nan
+    del eI, validMask, smoothedWeights
     return smoothedDemArray
 
-def anisodiff(img, niter, kappa, gamma, step=(1., 1.), option=2):
+
+# 'valid' 2D convolution of array with the outer product of kernel1d
+def separable_convolve_valid(array, kernel1d, method='separable'):
+    if method == 'fft':
+        import scipy.signal as conv2
+        smoothed = conv2.oaconvolve(array, kernel1d[:, np.newaxis], 'valid')
+        return conv2.oaconvolve(smoothed, kernel1d[np.newaxis, :], 'valid')
+    from scipy import ndimage
+    half = len(kernel1d)//2
+    smoothed = ndimage.convolve1d(array, kernel1d, axis=0, mode='constant')
+    smoothed = smoothed[half:smoothed.shape[0]-half]
+    smoothed = ndimage.convolve1d(smoothed, kernel1d, axis=1,
+                                  mode='constant')
+    return smoothed[:, half:smoothed.shape[1]-half]
+
+def anisodiff(img, niter, kappa, gamma, step=(1., 1.), option=2,
+              engine='numpy', tolerance=0., residuals=None,
+              residualMetric='max', checkpointPath=None,
+              checkpointInterval=0):
+    # With tolerance > 0 the iterations stop once the residual (size of
+    # one iteration's update over valid cells) drops below it. Residuals
+    # of every iteration run are appended to the residuals list if given.
+    # With checkpointPath and checkpointInterval > 0 the state is kept in
+    # memory-mapped files and checkpointed every checkpointInterval
+    # iterations, see anisodiff_checkpointed.
+    if checkpointPath and checkpointInterval > 0:
+        if engine == 'multiprocess':
+            print('checkpointing is not available for the multiprocess'
+                  ' engine, using numba')
+            engine = 'numba'
+        return anisodiff_checkpointed(img, niter, kappa, gamma, step, option,
+                                      engine, tolerance, residuals,
+                                      residualMetric, checkpointPath,
+                                      checkpointInterval)
+    if engine == 'numba':
+        return anisodiff_numba(img, niter, kappa, gamma, step, option,
+                               tolerance, residuals, residualMetric)
+    elif engine == 'multiprocess':
+        return anisodiff_multiprocess(img, niter, kappa, gamma, step, option,
+                                      defaults.nFilterWorkers, tolerance,
+                                      residuals, residualMetric)
+    trackResidual = tolerance > 0 or residuals is not None
     # initialize output array
     img = img.astype('float32')
     imgout = img.copy()
+    for ii in range(niter):
+        update = gamma*perona_malik_divergence(imgout, kappa, step, option)
+        imgout += update
+        if trackResidual and filter_converged(
+                update_residual_parts(update), ii, tolerance, residuals,
+                residualMetric):
+            break
+    return imgout
+
+
+# Checkpoint files of a filter run: three float32 .npy buffers and a json
+# state file naming the buffer that holds the state after 'iteration'
+def filter_checkpoint_files(checkpointPath):
+    return ([checkpointPath + '_%d.npy' % i for i in range(3)],
+            checkpointPath + '_state.json')
+
+
+# What a checkpoint must match to be resumed: every filter parameter and
+# the input DEM itself, by a hash of its values
+def filter_checkpoint_run(img, niter, kappa, gamma, step, option):
+    return {'shape': list(img.shape), 'niter': int(niter),
+            'kappa': float(kappa), 'gamma': float(gamma),
+            'step': [float(s) for s in step], 'option': int(option),
+            'input': hashlib.sha1(np.ascontiguousarray(img)).hexdigest()}
+
+
+# Open the checkpoint buffers. If a checkpoint of the same run (see
+# filter_checkpoint_run) exists it is resumed, otherwise img is copied into
+# a fresh set. Returns buffers, index of the current one, iterations done
+# and residuals logged so far.
+def open_filter_checkpoint(checkpointPath, img, run):
+    bufferPaths, statePath = filter_checkpoint_files(checkpointPath)
+    state = None
+    if os.path.isfile(statePath):
+        with open(statePath) as f:
+            state = json.load(f)
+        if any(state.get(key) != value for key, value in run.items()) or \
+                not 0 <= state.get('iteration', -1) <= run['niter']:
+            print(('ignoring checkpoint of a different filter run:',
+                   statePath))
+            state = None
+    if state is None:
+        buffers = [open_memmap(path, mode='w+', dtype='float32',
+                               shape=img.shape) for path in bufferPaths]
+        buffers[0][:] = img
+        return buffers, 0, 0, []
+    print(('resuming filtering from checkpoint at iteration',
+           state['iteration']))
+    buffers = [open_memmap(path, mode='r+') for path in bufferPaths]
+    return buffers, state['buffer'], state['iteration'], state['residuals']
+
+
+# Flush the current buffer and atomically replace the state file, so a
+# crash at any point leaves a consistent checkpoint on disk
+def save_filter_checkpoint(checkpointPath, buffers, current, iteration,
+                           run, residuals):
+    buffers[current].flush()
+    statePath = filter_checkpoint_files(checkpointPath)[1]
+    state = dict(run, iteration=iteration, buffer=current,
+                 residuals=residuals)
+    with open(statePath + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(statePath + '.tmp', statePath)
+
+
+def remove_filter_checkpoint(checkpointPath):
+    bufferPaths, statePath = filter_checkpoint_files(checkpointPath)
+    for path in bufferPaths + [statePath]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def anisodiff_checkpointed(img, niter, kappa, gamma, step=(1., 1.),
+                           option=2, engine='numpy', tolerance=0.,
+                           residuals=None, residualMetric='max',
+                           checkpointPath='PM_checkpoint',
+                           checkpointInterval=10):
+    # Iterations ping-pong between the two buffers that do not hold the
+    # last checkpoint. A checkpoint is a flush of the current buffer and a
+    # new state file; the previous checkpoint buffer then rejoins the
+    # rotation. Nothing is copied or pickled.
+    trackResidual = tolerance > 0 or residuals is not None
+    img = img.astype('float32')
+    run = filter_checkpoint_run(img, niter, kappa, gamma, step, option)
+    buffers, current, start, logged = open_filter_checkpoint(
+        checkpointPath, img, run)
+    del img
+    if residuals is not None:
+        residuals.extend(logged)
+    logged = list(logged)
+    saved = current
+    rowParts = np.zeros((buffers[0].shape[0], 3))
+    for ii in range(start, niter):
+        target = 3 - current - saved if current != saved else \
+            (current + 1) % 3
+        if engine == 'numba':
+            jit_kernels(globals())
+            perona_malik_step(buffers[current], buffers[target], kappa,
+                              gamma, step[0], step[1], option, rowParts)
+            parts = combine_residual_parts(rowParts)
+        else:
+            update = gamma*perona_malik_divergence(buffers[current], kappa,
+                                                   step, option)
+            np.add(buffers[current], update, out=buffers[target])
+            parts = update_residual_parts(update) if trackResidual else None
+        current = target
+        converged = trackResidual and filter_converged(
+            parts, ii, tolerance, residuals, residualMetric)
+        if trackResidual:
+            logged.append(filter_residual(parts, residualMetric))
+        if converged:
+            break
+        if (ii+1) % checkpointInterval == 0 and ii+1 < niter:
+            save_filter_checkpoint(checkpointPath, buffers, current, ii+1,
+                                   run, logged)
+            saved = current
+    return np.array(buffers[current])
+
+
+# Largest absolute update, sum of squared updates and number of valid
+# cells; parts from separate blocks combine with combine_residual_parts
+def update_residual_parts(update):
+    valid = ~np.isnan(update)
+    if not valid.any():
+        return 0., 0., 0
+    return (float(np.nanmax(np.abs(update))),
+            float(np.nansum(update**2)), int(np.count_nonzero(valid)))
+
 
-    # initialize some internal variables
+def combine_residual_parts(parts):
+    parts = np.asarray(parts, dtype='float64').reshape(-1, 3)
+    return (float(parts[:, 0].max()), float(parts[:, 1].sum()),
+            int(parts[:, 2].sum()))
+
+
+# Residual of one iteration: 'max' (largest absolute update) or 'rms'
+def filter_residual(parts, residualMetric='max'):
+    maxUpdate, sumSquares, count = parts
+    if residualMetric == 'rms':
+        return float(np.sqrt(sumSquares/count)) if count else 0.
+    return maxUpdate
+
+
+# Record the residual of iteration ii and tell whether it converged
+def filter_converged(parts, ii, tolerance, residuals, residualMetric='max'):
+    residual = filter_residual(parts, residualMetric)
+    if residuals is not None:
+        residuals.append(residual)
+    if tolerance > 0 and residual < tolerance:
+        print(('filter converged after', ii+1, 'iterations, residual:',
+               residual))
+        return True
+    return False
+
+
+# Write per-iteration residuals as csv, to tune iteration budgets
+def write_filter_residuals(residuals, outfilepath, outfilename):
+    print(('writing filter residuals', outfilename))
+    with open(os.path.join(outfilepath, outfilename), 'w') as f:
+        f.write('iteration,residual\n')
+        for ii, residual in enumerate(residuals):
+            f.write('%d,%.9g\n' % (ii+1, residual))
+
+
+# Divergence of the Perona-Malik flux of imgout, i.e. the update of one
+# explicit iteration before scaling by gamma
+def perona_malik_divergence(imgout, kappa, step, option):
     deltaS = np.zeros_like(imgout)
     deltaE = deltaS.copy()
-    NS = deltaS.copy()
-    EW = deltaS.copy()
-    gS = np.ones_like(imgout)
-    gE = gS.copy()
-    step1 = step[0]
-    step2 = step[1]
+    # calculate the diffs
+    deltaS[:-1, :] = np.diff(imgout, axis=0)
+    deltaE[:, :-1] = np.diff(imgout, axis=1)
+    if option == 2:
+        #gS = gs_diff(deltaS,kappa,step1)
+        #gE = ge_diff(deltaE,kappa,step2)
+        gS = 1./(1.+(deltaS/kappa)**2.)/step[0]
+        gE = 1./(1.+(deltaE/kappa)**2.)/step[1]
+    elif option == 1:
+        gS = np.exp(-(deltaS/kappa)**2.)/step[0]
+        gE = np.exp(-(deltaE/kappa)**2.)/step[1]
+    # update matrices
+    E = gE*deltaE
+    S = gS*deltaS
+    # subtract a copy that has been shifted 'North/West' by one
+    # pixel. don't ask questions. just do it. trust me.
+    NS = S.copy()
+    EW = E.copy()
+    NS[1:, :] -= S[:-1, :]
+    EW[:, 1:] -= E[:, :-1]
+    # update the image
+    mNS = np.isnan(NS)
+    mEW = np.isnan(EW)
+    NS[mNS] = 0
+    EW[mEW] = 0
+    NS += EW
+    mNS &= mEW
+    NS[mNS] = np.nan
+    return NS
+
+
+# numba kernels, compiled on first use by jit_kernels(globals())
+prange = range
+kernelsCompiled = False
+
+
+# Perona-Malik conductance for a single difference
+@numba_kernel()
+def perona_malik_conductance(delta, kappa, step, option):
+    if option == 2:
+        return 1./(1.+(delta/kappa)**2.)/step
+    return np.exp(-(delta/kappa)**2.)/step
+
+
+# One explicit Perona-Malik iteration from src into dst. Fluxes,
+# conductances and the update are computed in a single pass per pixel,
+# with the same NaN handling as the NumPy path in anisodiff. Per-row
+# residual parts of the update are stored in rowParts.
+@numba_kernel(parallel=True)
+def perona_malik_step(src, dst, kappa, gamma, step1, step2, option,
+                      rowParts):
+    nrows, ncols = src.shape
+    for i in prange(nrows):
+        maxUpdate = 0.
+        sumSquares = 0.
+        count = 0
+        for j in range(ncols):
+            center = src[i, j]
+            # South flux of this pixel minus that of the pixel above
+            if i < nrows-1:
+                delta = src[i+1, j] - center
+                ns = perona_malik_conductance(delta, kappa,
+                                              step1, option)*delta
+            else:
+                ns = 0.
+            if i > 0:
+                delta = center - src[i-1, j]
+                ns -= perona_malik_conductance(delta, kappa,
+                                               step1, option)*delta
+            # East flux of this pixel minus that of the pixel to the left
+            if j < ncols-1:
+                delta = src[i, j+1] - center
+                ew = perona_malik_conductance(delta, kappa,
+                                              step2, option)*delta
+            else:
+                ew = 0.
+            if j > 0:
+                delta = center - src[i, j-1]
+                ew -= perona_malik_conductance(delta, kappa,
+                                               step2, option)*delta
+            if np.isnan(ns):
+                if np.isnan(ew):
+                    dst[i, j] = np.nan
+                    continue
+                ns = 0.
+            elif np.isnan(ew):
+                ew = 0.
+            update = gamma*(ns+ew)
+            dst[i, j] = center + update
+            if not np.isnan(update):
+                maxUpdate = max(maxUpdate, abs(update))
+                sumSquares += update*update
+                count += 1
+        rowParts[i, 0] = maxUpdate
+        rowParts[i, 1] = sumSquares
+        rowParts[i, 2] = count
+
+
+def anisodiff_numba(img, niter, kappa, gamma, step=(1., 1.), option=2,
+                    tolerance=0., residuals=None, residualMetric='max'):
+    # ping-pong between two buffers instead of per-iteration temporaries
+    trackResidual = tolerance > 0 or residuals is not None
+    imgout = img.astype('float32')
+    buffer = np.empty_like(imgout)
+    rowParts = np.zeros((imgout.shape[0], 3))
+    jit_kernels(globals())
+    for ii in range(niter):
+        perona_malik_step(imgout, buffer, kappa, gamma,
+                          step[0], step[1], option, rowParts)
+        imgout, buffer = buffer, imgout
+        if trackResidual and filter_converged(
+                combine_residual_parts(rowParts), ii, tolerance, residuals,
+                residualMetric):
+            break
+    return imgout
+
+
+# Bilinear upsampling of a decimated array back to shape, with coarse
+# pixel i lying on fine pixel i*factor
+def upsample_bilinear(coarse, shape, factor):
+    upsampled = coarse
+    for axis, n in enumerate(shape):
+        ncoarse = coarse.shape[axis]
+        position = np.arange(n)/factor
+        i0 = np.minimum(np.floor(position).astype(int), ncoarse-1)
+        i1 = np.minimum(i0+1, ncoarse-1)
+        weight = np.clip(position-i0, 0, 1)
+        weight = weight[:, np.newaxis] if axis == 0 else weight[np.newaxis, :]
+        upsampled = (np.take(upsampled, i0, axis=axis)*(1-weight) +
+                     np.take(upsampled, i1, axis=axis)*weight)
+    return upsampled
+
+
+def anisodiff_pyramid(img, niter, kappa, gamma, step=(1., 1.), option=2,
+                      engine='numpy', tolerance=0., residuals=None,
+                      residualMetric='max', levels=2, fineIterations=20):
+    # Coarse-to-fine Perona-Malik filtering. The DEM is Gaussian smoothed
+    # and decimated levels times; on a grid 2**levels coarser one explicit
+    # iteration diffuses as much as 2**levels full-resolution ones, so the
+    # niter-fineIterations long-wavelength iterations are run there. kappa
+    # and step scale with the pixel size so edges are detected at the same
+    # slope. The coarse update (filtered minus unfiltered coarse DEM) is
+    # upsampled and added to the DEM, which keeps the fine detail, and
+    # fineIterations full-resolution iterations finish the job. The coarse
+    # grid can't see pixel-scale roughness, which the single-level filter
+    # keeps smoothing in every iteration, so the difference to it is set
+    # by fineIterations (see filterPyramidFineIterations); it is small in
+    # RMS but not bounded cell by cell.
+    img = img.astype('float32')
+    fineIterations = min(fineIterations, niter)
+    factor = 2**levels
+    coarseIterations = int(np.ceil((niter-fineIterations)/factor))
+    if levels <= 0 or coarseIterations == 0:
+        return anisodiff(img, niter, kappa, gamma, step, option, engine,
+                         tolerance, residuals, residualMetric)
+    coarseImg = img
+    for level in range(levels):
+        coarseImg = simple_gaussian_smoothing(coarseImg, 5, 1.)[::2, ::2]
+    print(('pyramid filtering:', coarseIterations, 'iterations on a',
+           coarseImg.shape, 'grid,', fineIterations, 'at full resolution'))
+    coarseUpdate = anisodiff(coarseImg, coarseIterations, kappa*factor,
+                             gamma, (step[0]*factor, step[1]*factor),
+                             option, engine) - coarseImg
+    imgout = img + upsample_bilinear(np.nan_to_num(coarseUpdate),
+                                     img.shape, factor).astype('float32')
+    del coarseImg, coarseUpdate
+    return anisodiff(imgout, fineIterations, kappa, gamma, step, option,
+                     engine, tolerance, residuals, residualMetric)
+
+
+# Thomas algorithm for the tridiagonal systems along axis 0 of x, one
+# system per column, vectorized across columns. Row i of the system is
+# (1 + c[i-1] + c[i])*x[i] - c[i-1]*x[i-1] - c[i]*x[i+1] = rhs[i], with c
+# the coupling of rows i and i+1 (none beyond the ends). x holds rhs on
+# input and is solved in place; cp (shape of x) and denom (one row) are
+# work buffers, so nothing the size of the DEM is allocated.
+def solve_tridiagonal(coupling, x, cp, denom):
+    n = x.shape[0]
+    for i in range(n):
+        denom[:] = 1.
+        if i > 0:
+            # 1 + c[i-1] + c[i-1]*cp[i-1], the elimination of row i-1
+            denom += coupling[i-1]*(1.+cp[i-1])
+            x[i] += coupling[i-1]*x[i-1]
+        if i < n-1:
+            denom += coupling[i]
+            np.divide(coupling[i], denom, out=cp[i])
+            np.negative(cp[i], out=cp[i])
+        x[i] /= denom
+    for i in range(n-2, -1, -1):
+        x[i] -= cp[i]*x[i+1]
+    return x
+
+
+# Work buffers of aos_axis_solve for either axis of a DEM of this shape:
+# flat float32 (coupling, cp, denom) arrays viewed per axis
+def aos_work_buffers(shape):
+    size = shape[0]*shape[1]
+    return (np.empty(size, 'float32'), np.empty(size, 'float32'),
+            np.empty(max(shape), 'float32'))
+
+
+# Semi-implicit diffusion along axis 0: solves (I - 2*tau*A) x = u into
+# out, with A the Perona-Malik operator along that axis. Edges touching
+# NaN carry no flux, so NaN cells are decoupled from the valid ones.
+def aos_axis_solve(u, kappa, tau, step, option, out, work):
+    nrows, ncols = u.shape
+    coupling = work[0][:max(nrows-1, 0)*ncols].reshape(max(nrows-1, 0),
+                                                       ncols)
+    cp = work[1][:nrows*ncols].reshape(nrows, ncols)
+    denom = work[2][:ncols]
+    # 2*tau times the conductance of each edge
+    np.subtract(u[1:], u[:-1], out=coupling)
+    coupling /= kappa
+    np.square(coupling, out=coupling)
+    if option == 2:
+        coupling += 1.
+        np.reciprocal(coupling, out=coupling)
+    else:
+        np.negative(coupling, out=coupling)
+        np.exp(coupling, out=coupling)
+    coupling *= 2.*tau/step
+    np.nan_to_num(coupling, copy=False)
+    np.copyto(out, u)
+    np.nan_to_num(out, copy=False)
+    return solve_tridiagonal(coupling, out, cp, denom)
+
+
+def anisodiff_aos(img, totalTime, kappa, timeStep, step=(1., 1.), option=2,
+                  tolerance=0., residuals=None, residualMetric='max'):
+    # Additive operator splitting (Weickert et al., 1998): each iteration
+    # averages one implicit solve along columns and one along rows. It is
+    # stable for any time step, so the diffusion time of the explicit
+    # scheme is reached with far fewer iterations. All solves work in
+    # float32 buffers allocated once, like the explicit engines.
+    trackResidual = tolerance > 0 or residuals is not None
+    imgout = img.astype('float32')
+    niter = max(1, int(np.ceil(totalTime/timeStep)))
+    tau = totalTime/niter
+    print(('AOS iterations:', niter, 'time step:', tau))
+    update = np.empty_like(imgout)
+    imgE = np.empty(imgout.shape[::-1], 'float32')
+    work = aos_work_buffers(imgout.shape)
+    for ii in range(niter):
+        aos_axis_solve(imgout, kappa, tau, step[0], option, update, work)
+        aos_axis_solve(imgout.T, kappa, tau, step[1], option, imgE, work)
+        # update = (imgS + imgE)/2 - imgout
+        update += imgE.T
+        update *= 0.5
+        update -= imgout
+        imgout += update
+        if trackResidual and filter_converged(
+                update_residual_parts(update), ii, tolerance, residuals,
+                residualMetric):
+            break
+    return imgout
+
+
+# Worker advancing rows [r0, r1) of the shared ping-pong buffers. The rows
+# just outside the band are read from the shared source buffer, and the
+# barrier keeps every band on the same iteration. Residual parts of each
+# band go to the shared (niter, nWorkers, 3) history, from which every
+# worker takes the same early stopping decision; they are only computed
+# with trackResidual.
+def anisodiff_band_worker(shmNames, shape, r0, r1, niter, kappa, gamma,
+                          step, option, barrier, iworker, nWorkers,
+                          tolerance, residualMetric, trackResidual=True):
+    # shared_memory needs Python 3.8, so only the multiprocess engine
+    # requires it
+    from multiprocessing import shared_memory
+    shms = [shared_memory.SharedMemory(name=shmName) for shmName in shmNames]
+    buffers = [np.ndarray(shape, dtype='float32', buffer=shm.buf)
+               for shm in shms[:2]]
+    history = np.ndarray((niter, nWorkers, 3), dtype='float64',
+                         buffer=shms[2].buf)
+    top = max(r0-1, 0)
+    bottom = min(r1+1, shape[0])
     for ii in range(niter):
+        src = buffers[ii % 2]
+        dst = buffers[(ii+1) % 2]
+        NS = perona_malik_divergence(src[top:bottom], kappa, step, option)
+        update = gamma*NS[r0-top:r1-top]
+        dst[r0:r1] = src[r0:r1] + update
+        if trackResidual:
+            history[ii, iworker] = update_residual_parts(update)
+        barrier.wait()
+        if trackResidual and tolerance > 0 and filter_residual(
+                combine_residual_parts(history[ii]),
+                residualMetric) < tolerance:
+            break
+    del buffers, history
+    for shm in shms:
+        shm.close()
+
 
-        # calculate the diffs
-        deltaS[:-1, :] = np.diff(imgout, axis=0)
-        deltaE[:, :-1] = np.diff(imgout, axis=1)
-        if option == 2:
-            #gS = gs_diff(deltaS,kappa,step1)
-            #gE = ge_diff(deltaE,kappa,step2)
-            gS = 1./(1.+(deltaS/kappa)**2.)/step[0]
-            gE = 1./(1.+(deltaE/kappa)**2.)/step[1]
-        elif option == 1:
-            gS = np.exp(-(deltaS/kappa)**2.)/step[0]
-            gE = np.exp(-(deltaE/kappa)**2.)/step[1]
-        # update matrices
-        E = gE*deltaE
-        S = gS*deltaS
-        # subtract a copy that has been shifted 'North/West' by one
-        # pixel. don't ask questions. just do it. trust me.
-        NS[:] = S
-        EW[:] = E
-        NS[1:, :] -= S[:-1, :]
-        EW[:, 1:] -= E[:, :-1]
-        # update the image
-        mNS = np.isnan(NS)
-        mEW = np.isnan(EW)
-        NS[mNS] = 0
-        EW[mEW] = 0
-        NS += EW
-        mNS &= mEW
-        NS[mNS] = np.nan
-        imgout += gamma*NS
+def anisodiff_multiprocess(img, niter, kappa, gamma, step=(1., 1.), option=2,
+                           nWorkers=0, tolerance=0., residuals=None,
+                           residualMetric='max'):
+    # Row bands of the DEM are filtered by a pool of processes working on
+    # two buffers in shared memory. Every band uses the NumPy update, so
+    # the result is bit-identical to the serial path.
+    from multiprocessing import shared_memory
+    trackResidual = tolerance > 0 or residuals is not None
+    img = img.astype('float32')
+    if nWorkers <= 0:
+        nWorkers = os.cpu_count()
+    nWorkers = max(1, min(nWorkers, img.shape[0]))
+    shms = [shared_memory.SharedMemory(create=True, size=img.nbytes)
+            for k in range(2)]
+    shms.append(shared_memory.SharedMemory(create=True,
+                                           size=max(1, niter)*nWorkers*3*8))
+    try:
+        buffers = [np.ndarray(img.shape, dtype='float32', buffer=shm.buf)
+                   for shm in shms[:2]]
+        buffers[0][:] = img
+        # spawn, as forking after numba has started its threads can hang
+        ctx = mp.get_context('spawn')
+        barrier = ctx.Barrier(nWorkers)
+        bounds = np.linspace(0, img.shape[0], nWorkers+1).astype(int)
+        procs = [ctx.Process(target=anisodiff_band_worker,
+                            args=([shm.name for shm in shms], img.shape,
+                                  bounds[k], bounds[k+1], niter, kappa,
+                                  gamma, step, option, barrier, k, nWorkers,
+                                  tolerance, residualMetric, trackResidual))
+                 for k in range(nWorkers)]
+        for p in procs:
+            p.start()
+        # a failed worker would leave the others waiting on the barrier
+        pending = list(procs)
+        while pending:
+            wait([p.sentinel for p in pending])
+            for p in [p for p in pending if not p.is_alive()]:
+                pending.remove(p)
+                if p.exitcode != 0:
+                    barrier.abort()
+        if any(p.exitcode != 0 for p in procs):
+            raise RuntimeError('Perona-Malik filtering worker failed')
+        # replay the workers' stopping decision on the residual history
+        history = np.ndarray((niter, nWorkers, 3), dtype='float64',
+                             buffer=shms[2].buf)
+        nDone = niter
+        for ii in range(niter if trackResidual else 0):
+            if filter_converged(combine_residual_parts(history[ii]), ii,
+                                tolerance, residuals, residualMetric):
+                nDone = ii+1
+                break
+        imgout = buffers[nDone % 2].copy()
+        del buffers, history
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
     return imgout
 
 
-def lambda_nonlinear_filter(nanDemArray):
+def anisodiff_tiled(inFileName, outFileName, niter, kappa, gamma,
+                    step=(1., 1.), option=2, engine='numpy', tileSize=2048,
+                    haloIterations=0, nanFlag=None):
+    # Filter a geotiff tile by tile without loading it. Each pass runs
+    # haloIterations iterations on every tile with a halo just as wide,
+    # since the artificial tile border moves inward by one pixel per
+    # iteration; the tile cores are then identical to the in-memory filter.
+    # Passes exchange halos through scratch geotiffs next to outFileName.
+    if haloIterations <= 0 or haloIterations > niter:
+        haloIterations = niter
+    npasses = int(np.ceil(niter/haloIterations))
+    scratchFileNames = [os.path.join(os.path.dirname(outFileName),
+                                     'PM_filtered_scratch_%d.tif' % k)
+                        for k in range(2)]
+    srcFileName = inFileName
+    for ipass in range(npasses):
+        passIterations = min(haloIterations, niter-ipass*haloIterations)
+        if ipass == npasses-1:
+            dstFileName = outFileName
+        else:
+            dstFileName = scratchFileNames[ipass % 2]
+        print(('filtering pass', ipass+1, 'of', npasses,
+               'with', passIterations, 'iterations'))
+        srcDs = gdal.Open(srcFileName, gdal.GA_ReadOnly)
+        if ipass == npasses-1:
+            # georeferenced like the in-memory filtered DEM
+            dstDs = create_geotif(dstFileName, srcDs.RasterXSize,
+                                  srcDs.RasterYSize, gdal.GDT_Float32,
+                                  filtered_dem_profile(raster_profile(srcDs)))
+        else:
+            # scratch passes stay plain geotiffs, only the output may be a
+            # COG
+            dstDs = create_geotif_from_dataset(srcDs, dstFileName, False)
+        del srcDs
+        dstBand = dstDs.GetRasterBand(1)
+        # values below nanFlag only need converting in the raw DEM, like
+        # in the in-memory filter
+        for window, tile in iter_geotif_windows(
+                srcFileName, tileSize, passIterations, False,
+                nanFlag if ipass == 0 else None):
+            tile = anisodiff(tile, passIterations, kappa, gamma, step,
+                             option, engine)
+            dstBand.WriteArray(window_core(tile, window),
+                               window.xoff, window.yoff)
+        dstBand.FlushCache()
+        del dstBand, dstDs
+        finish_geotif(dstFileName)
+        srcFileName = dstFileName
+    for scratchFileName in scratchFileNames:
+        remove_geotif(scratchFileName)
+
+
+# Slope magnitude of the DEM tile by tile, from an array in memory or a
+# GDAL dataset. A 1 pixel halo keeps np.gradient central inside the DEM,
+# so the tiles match the slope of the whole DEM.
+def slope_magnitude_tiles(dem, tileSize, nanFlag=None):
+    if isinstance(dem, np.ndarray):
+        nrows, ncols = dem.shape
+    else:
+        band = dem.GetRasterBand(1)
+        nrows, ncols = dem.RasterYSize, dem.RasterXSize
+    for window in generate_raster_windows(nrows, ncols, tileSize, 1):
+        if isinstance(dem, np.ndarray):
+            tile = dem[window.yoff-window.top:
+                       window.yoff+window.ysize+window.bottom,
+                       window.xoff-window.left:
+                       window.xoff+window.xsize+window.right]
+        else:
+            tile = read_raster_window(band, window, nanFlag)
+        yield window_core(slope_magnitude(tile, Parameters.demPixelScale),
+                          window)
+
+
+# demSmoothingQuantile of the slope tiles yielded by tiles(), either from
+# a fixed-memory histogram sketch or exactly (same value as mquantiles)
+# with a second pass over the tiles
+def edge_threshold_from_tiles(tiles, quantileMethod):
+    if quantileMethod == 'twopass':
+        return exact_quantile_two_pass(tiles, defaults.demSmoothingQuantile)
+    sketch = HistogramQuantileSketch()
+    for tile in tiles():
+        sketch.update(tile)
+    return sketch.quantile(defaults.demSmoothingQuantile)
+
+
+def lambda_nonlinear_filter(nanDemArray, quantileMethod='mquantiles'):
+    if quantileMethod != 'mquantiles':
+        # avoid the full float64 gradient and its flattened copies
+        print ('Computing lambda = q-q-based nonlinear filtering threshold')
+        print(('dem smoothing Quantile', defaults.demSmoothingQuantile))
+        edgeThresholdValue = edge_threshold_from_tiles(
+            lambda: slope_magnitude_tiles(nanDemArray, 1024),
+            quantileMethod)
+        print(('edgeThresholdValue:', edgeThresholdValue))
+        return edgeThresholdValue
     print ('Computing slope of raw DTM')
-    slopeXArray, slopeYArray = np.gradient(nanDemArray,
-                                           Parameters.demPixelScale)
+    slopeMagnitudeDemArray = slope_magnitude(nanDemArray,
+                                             Parameters.demPixelScale)
     print(Parameters.demPixelScale)
-    slopeMagnitudeDemArray = np.sqrt(slopeXArray**2 + slopeYArray**2)
     print(('DEM slope array shape:'), slopeMagnitudeDemArray.shape)
     
     # plot the slope DEM array
@@ -111,6 +740,7 @@ def lambda_nonlinear_filter(nanDemArray):
     # quantile of the absolute value of the gradient.
 
     print ('Computing lambda = q-q-based nonlinear filtering threshold')
+    from scipy.stats.mstats import mquantiles
     slopeMagnitudeDemArray = slopeMagnitudeDemArray.flatten()
     slopeMagnitudeDemArray = slopeMagnitudeDemArray[~np.isnan(
         slopeMagnitudeDemArray)]
@@ -122,28 +752,123 @@ def lambda_nonlinear_filter(nanDemArray):
     return edgeThresholdValue
 
 
+def lambda_nonlinear_filter_tiled(ds, tileSize, nanFlag=None,
+                                  quantileMethod='mquantiles'):
+    # Same threshold as lambda_nonlinear_filter, computed tile by tile.
+    # The slope values don't fit in memory here, so mquantiles gives the
+    # in-memory value through the exact two-pass quantile over all tiles
+    # (reading the DEM twice), as twopass does; sketch reads it once.
+    print ('Computing lambda = q-q-based nonlinear filtering threshold')
+    print(('dem smoothing Quantile', defaults.demSmoothingQuantile))
+    if quantileMethod == 'mquantiles':
+        quantileMethod = 'twopass'
+    edgeThresholdValue = edge_threshold_from_tiles(
+        lambda: slope_magnitude_tiles(ds, tileSize, nanFlag),
+        quantileMethod)
+    print(('edgeThresholdValue:', edgeThresholdValue))
+    return edgeThresholdValue
+
+
+def main_tiled():
+    ds = read_dem_georeference(Parameters.demFileName,
+                               Parameters.demDataFilePath)
+    if defaults.diffusionMethod == 'PeronaMalik2':
+        option = 2
+    elif defaults.diffusionMethod == 'PeronaMalik1':
+        option = 1
+    else:
+        print((defaults.diffusionMethod+" filter is not available in the"
+               " tiled mode of the current version GeoNet"))
+        return
+    edgeThresholdValue = lambda_nonlinear_filter_tiled(
+        ds, defaults.filterTileSize, defaults.demNanFlag,
+        quantileMethod=defaults.lambdaQuantileMethod)
+    del ds
+    anisodiff_tiled(os.path.join(Parameters.demDataFilePath,
+                                 Parameters.demFileName),
+                    Parameters.pmGrassGISfileName,
+                    defaults.nFilterIterations, edgeThresholdValue,
+                    defaults.diffusionTimeIncrement,
+                    (Parameters.demPixelScale, Parameters.demPixelScale),
+                    option, defaults.diffusionEngine,
+                    defaults.filterTileSize, defaults.filterHaloIterations,
+                    defaults.demNanFlag)
+
+
 def main():
+    if defaults.filterTileSize > 0:
+        main_tiled()
+        return
     nanDemArray = read_dem_from_geotiff(Parameters.demFileName,
                                         Parameters.demDataFilePath)
     nanDemArray[nanDemArray < defaults.demNanFlag] = np.nan
+    if defaults.doGaussianPreSmoothing == 1:
+        print ('Gaussian pre-smoothing of the DEM')
+        nanDemArray = simple_gaussian_smoothing(nanDemArray,
+                                                defaults.gaussianKernelWidth,
+                                                defaults.diffusionSigmaSquared)
+    residuals = [] if defaults.doFilterResidualLog == 1 else None
+    demName = Parameters.demFileName.split('.')[0]
+    checkpointPath = os.path.join(Parameters.geonetResultsDir,
+                                  demName + '_PM_checkpoint')
+    if defaults.filterPyramidLevels > 0:
+        explicitFilter = partial(
+            anisodiff_pyramid, levels=defaults.filterPyramidLevels,
+            fineIterations=defaults.filterPyramidFineIterations)
+    else:
+        explicitFilter = partial(
+            anisodiff, checkpointPath=checkpointPath,
+            checkpointInterval=defaults.filterCheckpointInterval)
     if defaults.diffusionMethod == 'PeronaMalik2':
-        edgeThresholdValue = lambda_nonlinear_filter(nanDemArray)
-        filteredDemArray = anisodiff(nanDemArray, defaults.nFilterIterations,
-                                     edgeThresholdValue,
-                                     defaults.diffusionTimeIncrement,
-                                     (Parameters.demPixelScale,
-                                      Parameters.demPixelScale), 2)
+        edgeThresholdValue = lambda_nonlinear_filter(
+            nanDemArray, defaults.lambdaQuantileMethod)
+        filteredDemArray = explicitFilter(nanDemArray,
+                                          defaults.nFilterIterations,
+                                          edgeThresholdValue,
+                                          defaults.diffusionTimeIncrement,
+                                          (Parameters.demPixelScale,
+                                           Parameters.demPixelScale), 2,
+                                          defaults.diffusionEngine,
+                                          defaults.filterConvergenceTolerance,
+                                          residuals,
+                                          defaults.filterResidualMetric)
     elif defaults.diffusionMethod == 'PeronaMalik1':
-        edgeThresholdValue = lambda_nonlinear_filter(nanDemArray)
-        filteredDemArray = anisodiff(nanDemArray, defaults.nFilterIterations,
-                                     edgeThresholdValue,
-                                     defaults.diffusionTimeIncrement,
-                                     (Parameters.demPixelScale,
-                                      Parameters.demPixelScale), 1)
-
+        edgeThresholdValue = lambda_nonlinear_filter(
+            nanDemArray, defaults.lambdaQuantileMethod)
+        filteredDemArray = explicitFilter(nanDemArray,
+                                          defaults.nFilterIterations,
+                                          edgeThresholdValue,
+                                          defaults.diffusionTimeIncrement,
+                                          (Parameters.demPixelScale,
+                                           Parameters.demPixelScale), 1,
+                                          defaults.diffusionEngine,
+                                          defaults.filterConvergenceTolerance,
+                                          residuals,
+                                          defaults.filterResidualMetric)
+    elif defaults.diffusionMethod == 'PeronaMalikAOS':
+        # same total diffusion time as the explicit scheme
+        edgeThresholdValue = lambda_nonlinear_filter(
+            nanDemArray, defaults.lambdaQuantileMethod)
+        filteredDemArray = anisodiff_aos(nanDemArray,
+                                         defaults.nFilterIterations *
+                                         defaults.diffusionTimeIncrement,
+                                         edgeThresholdValue,
+                                         defaults.aosTimeIncrement,
+                                         (Parameters.demPixelScale,
+                                          Parameters.demPixelScale), 2,
+                                         defaults.filterConvergenceTolerance,
+                                         residuals,
+                                         defaults.filterResidualMetric)
+    elif defaults.diffusionMethod == 'Gaussian':
+        filteredDemArray = simple_gaussian_smoothing(
+            nanDemArray, defaults.gaussianKernelWidth,
+            defaults.diffusionSigmaSquared)
     else:
         print((defaults.diffusionMethod+" filter is not available in the"))
         "current version GeoNet"   
+    if residuals:
+        write_filter_residuals(residuals, Parameters.geonetResultsDir,
+                               demName + '_filter_residuals.csv')
     # plot the filtered DEM
     #if defaults.doPlot == 1:
     #    raster_plot(filteredDemArray, 'Filtered DEM')
@@ -151,6 +876,8 @@ def main():
     # Writing the filtered DEM as a tif
     write_geotif_filteredDEM(filteredDemArray, Parameters.demDataFilePath,
                              Parameters.demFileName)
+    # the run is complete, checkpoints are no longer needed
+    remove_filter_checkpoint(checkpointPath)
 
 if __name__ == '__main__':
     t0 = perf_counter()
@@ -1,15 +1,17 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import cm
 import pygeonet_defaults as defaults
 
+# matplotlib is imported by the plotting functions, so importing this
+# module (and the stages that star-import it) stays cheap
+
 
 def raster_plot(Array, title):
+    import matplotlib.pyplot as plt
     if not hasattr(defaults, 'figureNumber'):
         defaults.figureNumber = 0
     defaults.figureNumber = defaults.figureNumber + 1
     plt.figure(defaults.figureNumber)
-    plt.imshow(Array, cmap=cm.coolwarm)
+    plt.imshow(Array, cmap='coolwarm')
     plt.xlabel('X')
     plt.ylabel('Y')
     plt.title(title)
@@ -22,7 +24,8 @@ def raster_plot(Array, title):
         #plt.close()
 
 
-def raster_point_plot(Array, PointsList, title, color=cm.coolwarm, point_style='go'):
+def raster_point_plot(Array, PointsList, title, color='coolwarm', point_style='go'):
+    import matplotlib.pyplot as plt
     if not hasattr(defaults, 'figureNumber'):
         defaults.figureNumber = 0
     defaults.figureNumber = defaults.figureNumber + 1
@@ -41,12 +44,13 @@ def raster_point_plot(Array, PointsList, title, color=cm.coolwarm, point_style='
         #plt.close()
 
 def geodesic_contour_plot(geodesicDistanceArray, title):
+    import matplotlib.pyplot as plt
     if not hasattr(defaults, 'figureNumber'):
         defaults.figureNumber = 0
     defaults.figureNumber = defaults.figureNumber + 1
     plt.figure(defaults.figureNumber)
-    plt.imshow(np.log10(geodesicDistanceArray),cmap=cm.coolwarm)
-    plt.contour(geodesicDistanceArray,140,cmap=cm.coolwarm)
+    plt.imshow(np.log10(geodesicDistanceArray),cmap='coolwarm')
+    plt.contour(geodesicDistanceArray,140,cmap='coolwarm')
     plt.title(title)
     plt.colorbar()
     if defaults.doPlot==1:
@@ -57,8 +61,9 @@ def geodesic_contour_plot(geodesicDistanceArray, title):
         #plt.close()
         
 def channel_plot(flowDirectionsArray,geodesicPathsCellList,
-                 xx,yy,title,color=cm.coolwarm,
+                 xx,yy,title,color='coolwarm',
                  point_style='go',line_style='k-'):
+    import matplotlib.pyplot as plt
     if not hasattr(defaults, 'figureNumber'):
         defaults.figureNumber = 0
     defaults.figureNumber = defaults.figureNumber + 1
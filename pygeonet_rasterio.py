@@ -1,13 +1,155 @@
 # PyGeoNet functions for raster I/O
 import os
 import sys
+import json
+import threading
 import numpy as np
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from osgeo import gdal
+from osgeo import gdal_array
 from osgeo import osr
 from osgeo import ogr
 import pygeonet_prepare as Parameters
 import pygeonet_defaults as defaults
-from rasterio.crs import CRS
+from pygeonet_statistics import RasterStatistics, array_statistics, \
+    is_dask_array, iter_array_blocks
+
+# Window of a raster: the core region plus the number of halo pixels
+# read around it on each side (clipped at the raster edges)
+RasterWindow = namedtuple('RasterWindow', ['xoff', 'yoff', 'xsize', 'ysize',
+                                           'top', 'left', 'bottom', 'right'])
+
+
+# Georeference of a raster: geotransform, projection (wkt) and size.
+# Readers return it and writers take it as profile=, so rasters of
+# different DEMs can be handled side by side in one process. Writers
+# without a profile fall back on the georeference last read into
+# Parameters.
+class RasterProfile(namedtuple('RasterProfile', ['geotransform', 'wktInfo',
+                                                 'nrows', 'ncols'])):
+    __slots__ = ()
+
+    @property
+    def pixelScale(self):
+        return float(self.geotransform[1])
+
+
+def raster_profile(ds):
+    return RasterProfile(tuple(ds.GetGeoTransform()), ds.GetProjection(),
+                         ds.RasterYSize, ds.RasterXSize)
+
+
+# Compatibility shim: the Parameters globals read by older code
+def set_parameters_profile(profile):
+    Parameters.geotransform = profile.geotransform
+    Parameters.demPixelScale = profile.pixelScale
+    Parameters.xLowerLeftCoord = float(profile.geotransform[0])
+    Parameters.yLowerLeftCoord = float(profile.geotransform[3])
+    Parameters.inputwktInfo = profile.wktInfo
+
+
+def parameters_profile(nrows=None, ncols=None):
+    return RasterProfile(tuple(Parameters.geotransform),
+                         Parameters.inputwktInfo, nrows, ncols)
+
+
+# Metadata of a raster kept with its cached dataset
+RasterMetadata = namedtuple('RasterMetadata', ['profile', 'blockSize',
+                                               'nodata', 'dataType'])
+
+# Read-only GDAL datasets and their metadata, least recently used first,
+# keyed by path, file stamp and thread: a rewritten file is opened afresh
+# and handles are never shared between threads. The size limit is on
+# files, each keeping one handle per live thread that read it, so dask
+# and writer threads don't evict each other. Parsed spatial references
+# are cached by wkt.
+datasetCache = OrderedDict()
+srsCache = {}
+datasetCacheLock = threading.Lock()
+
+
+def dataset_cache_key(fileName):
+    fileName = os.path.abspath(fileName)
+    stamp = tuple(file_stamp(fileName)) if os.path.isfile(fileName) else None
+    return fileName, stamp, threading.get_ident()
+
+
+# Open dataset and metadata of fileName from the cache, opening it on a miss
+def cached_dataset_entry(fileName):
+    key = dataset_cache_key(fileName)
+    with datasetCacheLock:
+        if key in datasetCache:
+            touch_cached_file(key[0])
+            return datasetCache[key]
+    ds = gdal.Open(fileName, gdal.GA_ReadOnly)
+    if ds is None:
+        print(('Could not open ' + fileName))
+        sys.exit(1)
+    band = ds.GetRasterBand(1)
+    metadata = RasterMetadata(raster_profile(ds), tuple(band.GetBlockSize()),
+                              band.GetNoDataValue(), band.DataType)
+    del band
+    with datasetCacheLock:
+        # older stamps of the file are stale
+        for oldKey in [k for k in datasetCache
+                       if k[0] == key[0] and k[1] != key[1]]:
+            del datasetCache[oldKey]
+        datasetCache[key] = (ds, metadata)
+        touch_cached_file(key[0])
+        # handles of finished threads are of no further use
+        alive = set(thread.ident for thread in threading.enumerate())
+        for oldKey in [k for k in datasetCache if k[2] not in alive]:
+            del datasetCache[oldKey]
+        while len(set(k[0] for k in datasetCache)) > \
+                max(defaults.datasetCacheSize, 1):
+            oldest = next(iter(datasetCache))[0]
+            for oldKey in [k for k in datasetCache if k[0] == oldest]:
+                del datasetCache[oldKey]
+    return ds, metadata
+
+
+# Mark all cached handles of a file as most recently used (the cache lock
+# is held by the caller)
+def touch_cached_file(fileName):
+    for key in [k for k in datasetCache if k[0] == fileName]:
+        datasetCache.move_to_end(key)
+
+
+def cached_dataset(fileName):
+    return cached_dataset_entry(fileName)[0]
+
+
+def raster_metadata(fileName):
+    return cached_dataset_entry(fileName)[1]
+
+
+def cached_srs(wktInfo):
+    with datasetCacheLock:
+        if wktInfo not in srsCache:
+            srsCache[wktInfo] = osr.SpatialReference(wkt=wktInfo)
+        return srsCache[wktInfo]
+
+
+# Close cached datasets of fileName (all with None), e.g. before it is
+# rewritten
+def invalidate_dataset_cache(fileName=None):
+    with datasetCacheLock:
+        if fileName is None:
+            datasetCache.clear()
+            return
+        fileName = os.path.abspath(fileName)
+        for key in [k for k in datasetCache if k[0] == fileName]:
+            del datasetCache[key]
+
+
+# Delete a geotiff, closing its cached datasets first (Windows can't remove
+# a file that is still open)
+def remove_geotif(fileName):
+    invalidate_dataset_cache(fileName)
+    if os.path.exists(fileName):
+        os.remove(fileName)
 
 # Read dem information
 def read_dem_from_geotiff(demFileName, demFilePath):
@@ -16,124 +158,940 @@ def read_dem_from_geotiff(demFileName, demFilePath):
     print(('reading geotiff', demFileName))
     # Use GDAL functions to read the dem as a numpy array
     # and get the dem extent, resolution, and projection
-    ary = []
     gdal.UseExceptions()
-    ds = gdal.Open(fullFilePath, gdal.GA_ReadOnly)
-    driver = ds.GetDriver()
-    geotransform = ds.GetGeoTransform()
-    Parameters.geotransform = geotransform
-    ary = ds.GetRasterBand(1).ReadAsArray()
-    Parameters.demPixelScale = float(geotransform[1])
-    Parameters.xLowerLeftCoord = float(geotransform[0])
-    Parameters.yLowerLeftCoord = float(geotransform[3])
-    Parameters.inputwktInfo = ds.GetProjection()
+    ds, metadata = cached_dataset_entry(fullFilePath)
+    set_parameters_profile(metadata.profile)
+    # an integer DEM is converted to float32 while it is decoded, so the
+    # no data cells can be set to NaN
+    out = None
+    if geotif_numpy_dtype(fullFilePath).kind != 'f':
+        out = np.empty((ds.RasterYSize, ds.RasterXSize), 'float32')
     # return the dem as a numpy array
+    return read_geotif_parallel(fullFilePath, out)
+
+
+# Read dem georeference without loading the raster, for tiled processing
+def read_dem_georeference(demFileName, demFilePath):
+    fullFilePath = os.path.join(demFilePath, demFileName)
+    gdal.UseExceptions()
+    ds = gdal.Open(fullFilePath, gdal.GA_ReadOnly)
+    set_parameters_profile(raster_profile(ds))
+    return ds
+
+
+# Split a raster into tiles, each with a halo of up to halo pixels.
+# tileSize is an edge in pixels or a (rows, columns) pair.
+def generate_raster_windows(nrows, ncols, tileSize, halo=0):
+    tileRows, tileCols = np.broadcast_to(tileSize, 2)
+    for yoff in range(0, nrows, tileRows):
+        ysize = min(tileRows, nrows-yoff)
+        for xoff in range(0, ncols, tileCols):
+            xsize = min(tileCols, ncols-xoff)
+            yield RasterWindow(xoff, yoff, xsize, ysize,
+                               min(halo, yoff), min(halo, xoff),
+                               min(halo, nrows-yoff-ysize),
+                               min(halo, ncols-xoff-xsize))
+
+
+# Window of the given core region with a halo of up to halo pixels, the
+# region clipped to the raster on all sides (ValueError if nothing is left)
+def raster_window(nrows, ncols, xoff, yoff, xsize, ysize, halo=0):
+    x0, y0 = max(xoff, 0), max(yoff, 0)
+    x1, y1 = min(xoff+xsize, ncols), min(yoff+ysize, nrows)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError('Region (%d, %d, %d, %d) is outside the %d x %d'
+                         ' raster' % (xoff, yoff, xsize, ysize, ncols, nrows))
+    xoff, yoff, xsize, ysize = x0, y0, x1-x0, y1-y0
+    return RasterWindow(xoff, yoff, xsize, ysize, min(halo, yoff),
+                        min(halo, xoff), min(halo, nrows-yoff-ysize),
+                        min(halo, ncols-xoff-xsize))
+
+
+# Tile size of about tileSize pixels rounded to whole internal blocks of
+# the band, as (rows, columns), so each tile read touches whole blocks
+def block_aligned_tile_size(band, tileSize):
+    blockX, blockY = band.GetBlockSize()
+    return (max(tileSize//blockY, 1)*blockY, max(tileSize//blockX, 1)*blockX)
+
+
+# Read a window and its halo from a band as float32 (or the band's own
+# type with dtype=None), with values below nanFlag and equal to nodata set
+# to NaN
+def read_raster_window(band, window, nanFlag=None, nodata=None,
+                       dtype='float32'):
+    ary = band.ReadAsArray(window.xoff-window.left, window.yoff-window.top,
+                           window.xsize+window.left+window.right,
+                           window.ysize+window.top+window.bottom)
+    if dtype is not None:
+        ary = ary.astype(dtype)
+    elif (nanFlag is not None or nodata is not None) and \
+            ary.dtype.kind != 'f':
+        ary = ary.astype('float64')
+    if nanFlag is not None:
+        ary[ary < nanFlag] = np.nan
+    if nodata is not None and not np.isnan(nodata):
+        ary[ary == nodata] = np.nan
     return ary
 
 
-# Read geotif from file on a disk
-def read_geotif_filteredDEM():
-    intif = Parameters.pmGrassGISfileName
-    ds = gdal.Open(intif, gdal.GA_ReadOnly)
-    driver = ds.GetDriver()
-    ary = ds.GetRasterBand(1).ReadAsArray()
-    geotransform = ds.GetGeoTransform()
-    Parameters.geotransform = geotransform
-    Parameters.demPixelScale = float(geotransform[1])
-    Parameters.inputwktInfo = ds.GetProjection()
+def iter_geotif_windows(fileName, tileSize=2048, halo=0, nodataToNan=True,
+                        nanFlag=None, dtype='float32'):
+    """
+    Yield (window, array) over a geotiff in tiles of about tileSize pixels
+    aligned to the file's internal blocks, each array including a halo of
+    up to halo pixels (window_core strips it). With nodataToNan the band's
+    nodata value becomes NaN, as do values below nanFlag. Only one tile is
+    in memory at a time.
+    """
+    ds = cached_dataset(fileName)
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue() if nodataToNan else None
+    for window in generate_raster_windows(
+            ds.RasterYSize, ds.RasterXSize,
+            block_aligned_tile_size(band, tileSize), halo):
+        yield window, read_raster_window(band, window, nanFlag, nodata,
+                                         dtype)
+    del band, ds
+
+
+# Read one region of a geotiff (an AOI, a basin's bounding box, a tile)
+# with its halo, returning (window, array); I/O is that of the region only
+def read_geotif_subset(fileName, xoff, yoff, xsize, ysize, halo=0,
+                       nodataToNan=True, nanFlag=None, dtype='float32'):
+    ds = cached_dataset(fileName)
+    band = ds.GetRasterBand(1)
+    window = raster_window(ds.RasterYSize, ds.RasterXSize, xoff, yoff,
+                           xsize, ysize, halo)
+    nodata = band.GetNoDataValue() if nodataToNan else None
+    ary = read_raster_window(band, window, nanFlag, nodata, dtype)
+    del band, ds
+    return window, ary
+
+
+# Pixel region (xoff, yoff, xsize, ysize) covering the map coordinate
+# bounds of an AOI, for a north-up geotransform
+def bounds_to_pixel_region(geotransform, minx, miny, maxx, maxy):
+    xoff = int(np.floor((minx - geotransform[0])/geotransform[1]))
+    yoff = int(np.floor((maxy - geotransform[3])/geotransform[5]))
+    xend = int(np.ceil((maxx - geotransform[0])/geotransform[1]))
+    yend = int(np.ceil((miny - geotransform[3])/geotransform[5]))
+    return xoff, yoff, xend-xoff, yend-yoff
+
+
+# Strip the halo from an array read with read_raster_window
+def window_core(ary, window):
+    return ary[window.top:window.top+window.ysize,
+               window.left:window.left+window.xsize]
+
+
+# GTiff creation options from the geotiff* defaults. The predictor follows
+# the data type: floating point (3) for floats, horizontal differencing (2)
+# for integers; LERC has none, but an error bound.
+def geotiff_creation_options(dataType, cog=False, nbits=None):
+    compression = defaults.geotiffCompression.upper()
+    floatTypes = (gdal.GDT_Float32, gdal.GDT_Float64)
+    options = ['BIGTIFF=' + defaults.geotiffBigTiff]
+    if cog:
+        options += ['BLOCKSIZE=%d' % defaults.geotiffBlockSize,
+                    'OVERVIEWS=AUTO']
+    elif defaults.geotiffTiled == 1:
+        options += ['TILED=YES',
+                    'BLOCKXSIZE=%d' % defaults.geotiffBlockSize,
+                    'BLOCKYSIZE=%d' % defaults.geotiffBlockSize]
+    if compression != 'NONE':
+        options += ['COMPRESS=' + compression,
+                    'NUM_THREADS=' + str(defaults.geotiffNumThreads)]
+    # sub-byte samples (NBITS) take no predictor
+    if nbits is not None and not cog:
+        options.append('NBITS=%d' % nbits)
+    elif compression in ('DEFLATE', 'ZSTD', 'LZW'):
+        if cog:
+            predictor = 'FLOATING_POINT' if dataType in floatTypes else 'YES'
+        else:
+            predictor = '3' if dataType in floatTypes else '2'
+        options.append('PREDICTOR=' + predictor)
+    elif compression.startswith('LERC'):
+        options.append('MAX_Z_ERROR=' + str(defaults.geotiffLercMaxZError))
+    return options
+
+
+# COG output is staged in a tiled, uncompressed geotiff next to it and
+# copied into the COG layout (with overviews) by finish_geotif
+def cog_staging_path(output_fileName):
+    return output_fileName + '.staging.tif'
+
+
+# Create an empty single band geotiff with the configured creation options
+# and the georeference of profile (default: Parameters). With cog (default:
+# geotiffCog) the dataset is the staging file; call finish_geotif once it
+# is closed.
+def create_geotif(output_fileName, ncols, nrows, dataType, profile=None,
+                  cog=None, nodata=None, nbits=None):
+    if cog is None:
+        cog = defaults.geotiffCog == 1
+    if profile is None:
+        profile = parameters_profile()
+    # no cached handle may outlive the file it was opened on
+    invalidate_dataset_cache(output_fileName)
+    driver = gdal.GetDriverByName('GTiff')
+    if cog:
+        outDs = driver.Create(cog_staging_path(output_fileName), ncols,
+                              nrows, 1, dataType,
+                              ['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    else:
+        outDs = driver.Create(output_fileName, ncols, nrows, 1, dataType,
+                              geotiff_creation_options(dataType,
+                                                       nbits=nbits))
+    if outDs is None:
+        print(('Could not create ' + output_fileName))
+        sys.exit(1)
+    outDs.SetGeoTransform(tuple(profile.geotransform))
+    outDs.SetProjection(profile.wktInfo)
+    if nodata is not None:
+        outDs.GetRasterBand(1).SetNoDataValue(float(nodata))
+    return outDs
+
+
+# numpy dtype of a GDAL data type written by this module
+def numpy_dtype(dataType):
+    return np.dtype({gdal.GDT_Byte: 'uint8', gdal.GDT_Int16: 'int16',
+                     gdal.GDT_UInt32: 'uint32', gdal.GDT_Int32: 'int32',
+                     gdal.GDT_Float32: 'float32',
+                     gdal.GDT_Float64: 'float64'}[dataType])
+
+
+# (min, max, any NaN) of an array of whole numbers, read in row blocks;
+# None if some value has a fraction or is infinite
+def integer_value_range(ary, blockRows=1024):
+    minimum, maximum, hasNan = np.inf, -np.inf, False
+    for row in range(0, ary.shape[0], blockRows):
+        block = np.asarray(ary[row:row+blockRows])
+        if block.dtype.kind == 'f':
+            nan = np.isnan(block)
+            if nan.any():
+                hasNan = True
+                block = block[~nan]
+            if not np.isfinite(block).all() or \
+                    (np.floor(block) != block).any():
+                return None
+        if block.size > 0:
+            minimum = min(minimum, block.min())
+            maximum = max(maximum, block.max())
+    return minimum, maximum, hasNan
+
+
+# Narrowest GDAL data type that holds inputArray: 1 bit Byte for 0/1
+# masks, Byte, UInt32 or Int32 for whole numbers without NaN, else Float32
+# with NaN nodata (Float64 for whole numbers beyond float32 precision), so
+# NaN cells read back as NaN. Dask arrays are typed from their dtype
+# alone. Returns (type, nodata, nbits).
+def compact_data_type(inputArray):
+    dtype = np.dtype(inputArray.dtype)
+    if dtype.kind == 'b':
+        return gdal.GDT_Byte, None, 1
+    if is_dask_array(inputArray):
+        if dtype.kind not in 'iu':
+            return gdal.GDT_Float32, np.nan, None
+        if dtype.itemsize == 1 and dtype.kind == 'u':
+            return gdal.GDT_Byte, None, None
+        if dtype.itemsize <= 4 and dtype.kind == 'u':
+            return gdal.GDT_UInt32, None, None
+        return gdal.GDT_Int32, None, None
+    valueRange = integer_value_range(inputArray)
+    # fractions, or nothing but NaN
+    if valueRange is None or valueRange[0] > valueRange[1]:
+        return gdal.GDT_Float32, np.nan, None
+    minimum, maximum, hasNan = valueRange
+    if hasNan:
+        if max(-minimum, maximum) <= 2**24:
+            return gdal.GDT_Float32, np.nan, None
+        return gdal.GDT_Float64, np.nan, None
+    if minimum >= 0 and maximum <= 1:
+        return gdal.GDT_Byte, None, 1
+    for dataType, low, high in ((gdal.GDT_Byte, 0, 255),
+                                (gdal.GDT_UInt32, 0, 2**32-1),
+                                (gdal.GDT_Int32, -2**31, 2**31-1)):
+        if low <= minimum and maximum <= high:
+            return dataType, None, None
+    return gdal.GDT_Float64, np.nan, None
+
+
+# Copy a staged geotiff into its COG; nothing to do for plain geotiffs
+def finish_geotif(output_fileName):
+    stagingFileName = cog_staging_path(output_fileName)
+    if not os.path.isfile(stagingFileName):
+        return
+    print(('writing cloud optimized geotiff', os.path.basename(output_fileName)))
+    invalidate_dataset_cache(output_fileName)
+    srcDs = gdal.Open(stagingFileName, gdal.GA_ReadOnly)
+    dataType = srcDs.GetRasterBand(1).DataType
+    outDs = gdal.GetDriverByName('COG').CreateCopy(
+        output_fileName, srcDs, 0, geotiff_creation_options(dataType, True))
+    if outDs is None:
+        print(('Could not create ' + output_fileName))
+        sys.exit(1)
+    del outDs, srcDs
+    os.remove(stagingFileName)
+
+
+# Create an empty Float32 geotiff with the georeference of srcDs,
+# to be filled window by window
+def create_geotif_from_dataset(srcDs, output_fileName, cog=None):
+    return create_geotif(output_fileName, srcDs.RasterXSize,
+                         srcDs.RasterYSize, gdal.GDT_Float32,
+                         raster_profile(srcDs), cog)
+
+
+# Statistics sidecar of a raster: <raster>.stats.json with the valid count,
+# mean, std, min, max and percentiles, stamped with the raster's mtime and
+# size so a rewritten raster invalidates it
+def statistics_sidecar_path(fileName):
+    return fileName + '.stats.json'
+
+
+def file_stamp(fileName):
+    stat = os.stat(fileName)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+# Nodata value of a GeoTIFF, or for an .npy artifact that of the GeoTIFF
+# it was read from (None if it has none or was written from memory)
+def raster_nodata(fileName):
+    if fileName.endswith('.npy'):
+        with open(os.path.splitext(fileName)[0] + '.json') as f:
+            return json.load(f).get('nodata')
+    ds = cached_dataset(fileName)
+    nodata = ds.GetRasterBand(1).GetNoDataValue()
+    del ds
+    return nodata
+
+
+# block with nodata (unless None or NaN) set to NaN, as float64 if the
+# block is an integer array
+def nodata_to_nan(block, nodata):
+    if block.dtype.kind != 'f':
+        block = block.astype('float64')
+    if nodata is not None and not np.isnan(nodata):
+        block = np.where(block == nodata, np.nan, block)
+    return block
+
+
+# Callable returning a fresh iterator over the values of a GeoTIFF or .npy
+# artifact block by block (nodata as NaN, float64 for integer rasters),
+# restricted to the cells valid (not NaN) in maskFileName if given
+def raster_value_blocks(fileName, maskFileName=None, blockSize=2048):
+    def blocks():
+        nodata = None
+        if fileName.endswith('.npy'):
+            ary = np.load(fileName, mmap_mode='r')
+            nodata = raster_nodata(fileName)
+            windows = ((window, ary[window.yoff:window.yoff+window.ysize,
+                                    window.xoff:window.xoff+window.xsize])
+                       for window in generate_raster_windows(
+                           ary.shape[0], ary.shape[1], blockSize))
+        else:
+            # native data type, e.g. Float64 flow accumulation
+            windows = iter_geotif_windows(fileName, blockSize, dtype=None)
+        if maskFileName is not None:
+            maskBand = cached_dataset(maskFileName).GetRasterBand(1)
+            maskNodata = maskBand.GetNoDataValue()
+        for window, block in windows:
+            block = nodata_to_nan(block, nodata)
+            if maskFileName is not None:
+                block = block[~np.isnan(read_raster_window(
+                    maskBand, window, nodata=maskNodata))]
+            yield block
+    return blocks
+
+
+# The percentiles are exact: blocks() yields the values the statistics
+# were computed from again (default: read back from fileName) so the
+# histogram bins holding them are resolved, see exact_rank_values
+def write_statistics_sidecar(fileName, statistics, maskFileName=None,
+                             blocks=None):
+    if not defaults.doStatisticsSidecar or statistics.count == 0:
+        return
+    sidecar = {'count': statistics.count, 'mean': statistics.mean,
+               'std': statistics.std, 'min': statistics.min,
+               'max': statistics.max, 'percentiles': {},
+               'stamp': file_stamp(fileName), 'mask': None}
+    if statistics.sketch is not None:
+        if blocks is None:
+            blocks = raster_value_blocks(fileName, maskFileName)
+        qs = defaults.statisticsSidecarPercentiles
+        for q, value in zip(qs, statistics.exact_percentiles(blocks, qs)):
+            sidecar['percentiles'][str(q)] = value
+    if maskFileName is not None:
+        sidecar['mask'] = [maskFileName, file_stamp(maskFileName)]
+    with open(statistics_sidecar_path(fileName), 'w') as f:
+        json.dump(sidecar, f, indent=1)
+
+
+# Sidecar statistics of fileName if present and still matching the raster
+# (and mask), else None
+def read_statistics_sidecar(fileName, maskFileName=None):
+    sidecarPath = statistics_sidecar_path(fileName)
+    if not defaults.doStatisticsSidecar or not os.path.isfile(sidecarPath) \
+            or not os.path.isfile(fileName):
+        return None
+    with open(sidecarPath) as f:
+        sidecar = json.load(f)
+    if sidecar['stamp'] != file_stamp(fileName):
+        return None
+    if maskFileName is None:
+        mask = None
+    elif os.path.isfile(maskFileName):
+        mask = [maskFileName, file_stamp(maskFileName)]
+    else:
+        return None
+    if sidecar['mask'] != mask:
+        return None
+    return sidecar
+
+
+# Statistics of a geotiff, from its sidecar when fresh, otherwise streamed
+# block by block without loading the raster and saved to a new sidecar.
+# With maskFileName only cells valid (not NaN) in that raster are counted.
+def raster_statistics(fileName, maskFileName=None, blockSize=2048):
+    sidecar = read_statistics_sidecar(fileName, maskFileName)
+    if sidecar is not None:
+        print(('using statistics sidecar of', os.path.basename(fileName)))
+        return sidecar
+    print(('computing statistics of', os.path.basename(fileName)))
+    blocks = raster_value_blocks(fileName, maskFileName, blockSize)
+    statistics = RasterStatistics()
+    for block in blocks():
+        statistics.update(block)
+    write_statistics_sidecar(fileName, statistics, maskFileName, blocks)
+    sidecar = read_statistics_sidecar(fileName, maskFileName)
+    if sidecar is None:
+        sidecar = {'count': statistics.count, 'mean': statistics.mean,
+                   'std': statistics.std, 'min': statistics.min,
+                   'max': statistics.max}
+    return sidecar
+
+
+# Statistics for a writer's statistics= argument: a RasterStatistics, or
+# True to compute them from the array being written. They are stored in
+# the band (GDAL PAM) here and in the json sidecar once the file is closed.
+def set_band_statistics(outBand, inputArray, statistics):
+    if statistics is None or statistics is False:
+        return None
+    if statistics is True:
+        statistics = array_statistics(inputArray)
+    if statistics.count > 0:
+        outBand.SetStatistics(statistics.min, statistics.max,
+                              statistics.mean, statistics.std)
+    return statistics
+
+
+# Local dask cluster with one worker of nThreads threads (0 = all cores).
+# Threads rather than processes: GDAL handles are opened per chunk and the
+# numba kernels release the GIL.
+@contextmanager
+def dask_client(nThreads=0):
+    from dask.distributed import Client, LocalCluster
+    with LocalCluster(processes=False, n_workers=1,
+                      threads_per_worker=nThreads or os.cpu_count()) \
+            as cluster, Client(cluster) as client:
+        yield client
+
+
+def read_geotif_chunk(fileName, nanFlag=None, block_info=None):
+    # chunk of a dask array read by read_geotif_dask
+    (r0, r1), (c0, c1) = block_info[None]['array-location']
+    # each worker thread reuses its own cached handle
+    ds = cached_dataset(fileName)
+    ary = ds.GetRasterBand(1).ReadAsArray(c0, r0, c1-c0, r1-r0)
+    del ds
+    if nanFlag is not None:
+        ary = ary.astype('float32')
+        ary[ary < nanFlag] = np.nan
+    return ary
+
+
+# Lazy dask array of a geotiff in the data type of the file (float32 with
+# nanFlag). Chunks are about chunkSize pixels wide, rounded to whole
+# blocks of the file.
+def read_geotif_dask(fileName, chunkSize, nanFlag=None):
+    import dask.array as da
+    ds = cached_dataset(fileName)
+    band = ds.GetRasterBand(1)
+    shape = (ds.RasterYSize, ds.RasterXSize)
+    chunks = da.core.normalize_chunks(
+        block_aligned_tile_size(band, chunkSize), shape)
+    if nanFlag is None:
+        dtype = band.ReadAsArray(0, 0, 1, 1).dtype
+    else:
+        dtype = np.dtype('float32')
+    del band, ds
+    return da.map_blocks(read_geotif_chunk, fileName, nanFlag=nanFlag,
+                         chunks=chunks, dtype=dtype,
+                         meta=np.empty((0, 0), dtype=dtype))
+
+
+class GeotiffChunkWriter(object):
+    # Target of da.store: writes each chunk into the band of fileName and
+    # accumulates the statistics of what was written. da.store(lock=True)
+    # serializes the calls.
+    def __init__(self, fileName, statistics=None):
+        self.fileName = fileName
+        self.statistics = statistics
+
+    def __setitem__(self, key, value):
+        rows, cols = key
+        ds = gdal.Open(self.fileName, gdal.GA_Update)
+        ds.GetRasterBand(1).WriteArray(np.asarray(value), cols.start,
+                                       rows.start)
+        del ds
+        if self.statistics is not None:
+            self.statistics.update(value)
+
+
+# Compute a dask array chunk by chunk straight into a new tiled geotiff
+# with the georeference in Parameters
+def write_geotif_dask(inputArray, output_fileName, dataType,
+                      statistics=None, nodata=None, nbits=None,
+                      profile=None):
+    import dask.array as da
+    cog = defaults.geotiffCog == 1
+    outDs = create_geotif(output_fileName, inputArray.shape[1],
+                          inputArray.shape[0], dataType, profile, cog,
+                          nodata, nbits)
+    del outDs
+    if cog:
+        chunkFileName = cog_staging_path(output_fileName)
+    else:
+        chunkFileName = output_fileName
+    if statistics is True:
+        statistics = RasterStatistics()
+    elif statistics is False:
+        statistics = None
+    writer = GeotiffChunkWriter(chunkFileName, statistics)
+    da.store(inputArray, writer, lock=True)
+    if statistics is not None:
+        ds = gdal.Open(chunkFileName, gdal.GA_Update)
+        set_band_statistics(ds.GetRasterBand(1), None, statistics)
+        del ds
+    finish_geotif(output_fileName)
+    if statistics is not None:
+        write_statistics_sidecar(output_fileName, statistics)
+
+
+# Threads for whole-raster reads: rasterReadThreads, or with 0 the
+# GDAL_NUM_THREADS setting (a count or ALL_CPUS)
+def read_thread_count():
+    nThreads = defaults.rasterReadThreads
+    if nThreads <= 0:
+        nThreads = gdal.GetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+        if str(nThreads).upper() == 'ALL_CPUS':
+            nThreads = os.cpu_count() or 1
+    return max(int(nThreads), 1)
+
+
+# numpy dtype of the first band of a geotiff, of any GDAL data type
+def geotif_numpy_dtype(fileName):
+    return np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(
+        raster_metadata(fileName).dataType))
+
+
+# Buffer for the first band of a geotiff in shared memory, which other
+# processes can attach to by name; returns (SharedMemory, array), the
+# caller closes and unlinks the block
+def shared_geotif_buffer(fileName):
+    from multiprocessing import shared_memory
+    ds = cached_dataset(fileName)
+    dtype = geotif_numpy_dtype(fileName)
+    shape = (ds.RasterYSize, ds.RasterXSize)
+    shm = shared_memory.SharedMemory(
+        create=True, size=max(shape[0]*shape[1]*dtype.itemsize, 1))
+    return shm, np.ndarray(shape, dtype, buffer=shm.buf)
+
+
+# Read full-width strips (yoff, ysize) of a geotiff into the same rows of
+# out, with a dataset handle of this thread's own
+def read_geotif_strips(fileName, out, strips):
+    # the strips are already read in parallel, GDAL's decoding threads
+    # would only oversubscribe the cores
+    gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', '1')
+    ds = gdal.Open(fileName, gdal.GA_ReadOnly)
+    if ds is None:
+        print(('Could not open ' + fileName))
+        sys.exit(1)
+    band = ds.GetRasterBand(1)
+    for yoff, ysize in strips:
+        if band.ReadAsArray(0, yoff, out.shape[1], ysize,
+                            buf_obj=out[yoff:yoff+ysize]) is None:
+            print(('Could not read ' + fileName))
+            sys.exit(1)
+    del band, ds
+
+
+def read_geotif_parallel(fileName, out=None, nThreads=None):
+    """
+    Read the first band of a geotiff into one preallocated array: out
+    (e.g. from shared_geotif_buffer) or a new array of the band's type.
+    The rows are split in strips of whole internal blocks, about four per
+    thread, decoded by nThreads threads (default read_thread_count()).
+    With one thread, or a single strip, the band is read in one call and
+    GDAL_NUM_THREADS applies to decoding it.
+    """
+    ds, metadata = cached_dataset_entry(fileName)
+    nrows, ncols = ds.RasterYSize, ds.RasterXSize
+    if nThreads is None:
+        nThreads = read_thread_count()
+    blockRows = metadata.blockSize[1]
+    stripRows = max(nrows//(blockRows*nThreads*4), 1)*blockRows
+    strips = [(yoff, min(stripRows, nrows-yoff))
+              for yoff in range(0, nrows, stripRows)]
+    nThreads = min(nThreads, len(strips))
+    if nThreads <= 1:
+        ary = ds.GetRasterBand(1).ReadAsArray(buf_obj=out)
+        if ary is None:
+            print(('Could not read ' + fileName))
+            sys.exit(1)
+        return ary
+    if out is None:
+        out = np.empty((nrows, ncols), geotif_numpy_dtype(fileName))
+    with ThreadPoolExecutor(nThreads) as pool:
+        # interleaved strips share the load evenly between the threads
+        futures = [pool.submit(read_geotif_strips, fileName, out,
+                               strips[i::nThreads]) for i in range(nThreads)]
+        for future in futures:
+            future.result()
+    return out
+
+
+# Array and profile of a geotiff, as a lazy dask array with chunkSize > 0
+def read_geotif(fileName, chunkSize=0):
+    ds, metadata = cached_dataset_entry(fileName)
+    if chunkSize > 0:
+        ary = read_geotif_dask(fileName, chunkSize)
+    else:
+        ary = read_geotif_parallel(fileName)
+    return ary, metadata.profile
+
+
+# Read geotif from file on a disk, as a lazy dask array with chunkSize > 0
+def read_geotif_filteredDEM(chunkSize=0):
+    ary, profile = read_geotif(Parameters.pmGrassGISfileName, chunkSize)
+    set_parameters_profile(profile)
     return ary
 
 
-# Read geotif from file on a disk
-def read_geotif_generic(intifpath, intifname):
+# Read geotif from file on a disk, as a lazy dask array with chunkSize > 0
+def read_geotif_generic(intifpath, intifname, chunkSize=0):
+    from rasterio.crs import CRS
     intif = os.path.join(intifpath, intifname)
-    ds = gdal.Open(intif, gdal.GA_ReadOnly)
+    ds = cached_dataset(intif)
     prj = ds.GetProjection()
     crs = CRS.from_wkt(prj)
-    ary = ds.GetRasterBand(1).ReadAsArray()
+    if chunkSize > 0:
+        ary = read_geotif_dask(intif, chunkSize)
+    else:
+        ary = read_geotif_parallel(intif)
     return ary,crs,ds
 
 
-# Write geotif to file on a disk
-def write_geotif_generic(inputArray, outfilepath, outfilename):
-    print(('writing geotiff', outfilename))
-    output_fileName = os.path.join(outfilepath, outfilename)
+# Write a numpy or dask array as a geotiff with the georeference of
+# profile (default: Parameters), of the given GDAL data type or, with
+# dataType None, of the compact data type of the array
+def write_geotif_array(inputArray, output_fileName, dataType=None,
+                       statistics=None, profile=None):
+    nodata, nbits = None, None
+    if dataType is None:
+        dataType, nodata, nbits = compact_data_type(inputArray)
+    if is_dask_array(inputArray):
+        write_geotif_dask(inputArray, output_fileName, dataType, statistics,
+                          nodata, nbits, profile)
+        return
     # Get shape
     nrows = inputArray.shape[0]
     ncols = inputArray.shape[1]
     # create the output image
-    driver = gdal.GetDriverByName('GTiff')
-    outDs = driver.Create(output_fileName, ncols, nrows, 1, gdal.GDT_Float32)
-    if outDs is None:
-        print(('Could not create ' + outfilename))
-        sys.exit(1)
+    outDs = create_geotif(output_fileName, ncols, nrows, dataType, profile,
+                          nodata=nodata, nbits=nbits)
     outBand = outDs.GetRasterBand(1)
-    # set the reference info
-    geotransform = Parameters.geotransform
-    cc = (geotransform[0], geotransform[1], geotransform[2],
-          geotransform[3], geotransform[4], geotransform[5])
-    outDs.SetGeoTransform(cc)
-    outDs.SetProjection(Parameters.inputwktInfo)
-    # write the band
+    # statistics of the valid cells, before NaN becomes nodata
     tmparray = np.array(inputArray)
-    outBand.WriteArray(tmparray)
+    statistics = set_band_statistics(outBand, tmparray, statistics)
+    if nodata is not None and not np.isnan(nodata):
+        tmparray[np.isnan(tmparray)] = nodata
+    # write the band
+    outBand.WriteArray(tmparray.astype(numpy_dtype(dataType), copy=False))
     # flush data to disk, set the NoData value and calculate stats
     outBand.FlushCache()
-    del tmparray, outDs, outBand, driver
+    del tmparray, outDs, outBand
+    finish_geotif(output_fileName)
+    if statistics is not None:
+        write_statistics_sidecar(output_fileName, statistics,
+                                 blocks=lambda: iter_array_blocks(inputArray))
+
 
 # Write geotif to file on a disk
-def write_geotif_skeleton(inputArray, outfilepath, outfilename):
+def write_geotif_generic(inputArray, outfilepath, outfilename,
+                         statistics=None, profile=None):
     print(('writing geotiff', outfilename))
     output_fileName = os.path.join(outfilepath, outfilename)
-    # Get shape
-    nrows = inputArray.shape[0]
-    ncols = inputArray.shape[1]
-    # create the output image
-    driver = gdal.GetDriverByName('GTiff')
-    outDs = driver.Create(output_fileName, ncols, nrows, 1, gdal.GDT_Int16)
-    if outDs is None:
-        print(('Could not create ' + outfilename))
-        sys.exit(1)
-    outBand = outDs.GetRasterBand(1)
-    # set the reference info
-    geotransform = Parameters.geotransform
-    cc = (geotransform[0], geotransform[1], geotransform[2],
-          geotransform[3], geotransform[4], geotransform[5])
-    outDs.SetGeoTransform(cc)
-    outDs.SetProjection(Parameters.inputwktInfo)
-    # write the band
-    tmparray = np.array(inputArray)
-    outBand.WriteArray(tmparray)
-    # flush data to disk, set the NoData value and calculate stats
-    outBand.FlushCache()
-    del tmparray, outDs, outBand, driver
+    if defaults.compactOutputDataTypes == 1:
+        dataType = None
+    else:
+        dataType = gdal.GDT_Float32
+    write_geotif_array(inputArray, output_fileName, dataType, statistics,
+                       profile)
+
+# Write geotif to file on a disk
+def write_geotif_skeleton(inputArray, outfilepath, outfilename,
+                          statistics=None, profile=None):
+    print(('writing geotiff', outfilename))
+    output_fileName = os.path.join(outfilepath, outfilename)
+    if defaults.compactOutputDataTypes == 1:
+        dataType = None
+    else:
+        dataType = gdal.GDT_Int16
+    write_geotif_array(inputArray, output_fileName, dataType, statistics,
+                       profile)
+
+
+# Profile of a filtered DEM: the projection of profile re-imported from
+# its EPSG code, in-memory and tiled filtering alike
+def filtered_dem_profile(profile):
+    outRasterSRS = osr.SpatialReference(wkt=profile.wktInfo)
+    authoritycode = outRasterSRS.GetAuthorityCode("PROJCS")
+    outRasterSRS.ImportFromEPSG(int(authoritycode))
+    return profile._replace(wktInfo=outRasterSRS.ExportToWkt())
 
 
 # Write filtered geotiff to disk to be used by GRASS GIS
-def write_geotif_filteredDEM(filteredDemArray, filepath, filename):
+def write_geotif_filteredDEM(filteredDemArray, filepath, filename,
+                             statistics=None, profile=None):
     print ('writing filtered DEM')
     output_fileName = Parameters.pmGrassGISfileName
     # Create gtif
     nrows = filteredDemArray.shape[0]
     ncols = filteredDemArray.shape[1]
     print(('filtered DEM size:', str(nrows), 'rowsx', str(ncols), 'columns'))
-    # create the output image
-    driver = gdal.GetDriverByName('GTiff')
-    outDs = driver.Create(output_fileName, ncols, nrows, 1, gdal.GDT_Float32)
-    if outDs is None:
-        print ('Could not create tif file')
-        sys.exit(1)
     # set the reference info
-    geotransform = Parameters.geotransform
-    outDs.SetGeoTransform(geotransform)
-    outDs.SetProjection(Parameters.inputwktInfo)
+    if profile is None:
+        profile = parameters_profile(nrows, ncols)
+    # create the output image
+    outDs = create_geotif(output_fileName, ncols, nrows, gdal.GDT_Float32,
+                          filtered_dem_profile(profile))
     # write the band
     outband = outDs.GetRasterBand(1)
     outband.WriteArray(filteredDemArray)
-    outRasterSRS = osr.SpatialReference(wkt=Parameters.inputwktInfo)
-    authoritycode = outRasterSRS.GetAuthorityCode("PROJCS")
-    outRasterSRS.ImportFromEPSG(int(authoritycode))
-    outDs.SetProjection(outRasterSRS.ExportToWkt())
+    statistics = set_band_statistics(outband, filteredDemArray, statistics)
     outband.FlushCache()
     # finishing the writing of filtered DEM
-    del outDs, outband, driver, outRasterSRS
+    del outDs, outband
+    finish_geotif(output_fileName)
+    if statistics is not None:
+        write_statistics_sidecar(
+            output_fileName, statistics,
+            blocks=lambda: iter_array_blocks(filteredDemArray))
+
+
+# Stage outputs as memory-mapped artifacts: <name>.npy (uncompressed) and
+# <name>.json (georeference, shape, dtype, nodata and the stamp of the
+# GeoTIFF of the same name at the time, if any) in the results directory.
+# Later stages map them with np.load instead of decoding the GeoTIFF.
+def artifact_paths(outfilepath, outfilename):
+    base = os.path.join(outfilepath, os.path.splitext(outfilename)[0])
+    return base + '.npy', base + '.json'
+
+
+def write_artifact(inputArray, outfilepath, outfilename, profile=None,
+                   nodata=None):
+    # nodata: that of the GeoTIFF the array was read from, if any
+    npyFileName, jsonFileName = artifact_paths(outfilepath, outfilename)
+    geotiffFileName = os.path.join(outfilepath, outfilename)
+    if profile is None:
+        profile = parameters_profile()
+    ary = np.asarray(inputArray)
+    # compact dtype as in the geotiff
+    if defaults.compactOutputDataTypes == 1:
+        ary = ary.astype(numpy_dtype(compact_data_type(ary)[0]), copy=False)
+    np.save(npyFileName, ary)
+    meta = {'geotransform': list(profile.geotransform),
+            'wkt': profile.wktInfo,
+            'shape': list(ary.shape),
+            'dtype': str(ary.dtype),
+            'nodata': nodata,
+            'geotiff': file_stamp(geotiffFileName)
+            if os.path.isfile(geotiffFileName) else None}
+    with open(jsonFileName, 'w') as f:
+        json.dump(meta, f)
+
+
+# An artifact is current unless the GeoTIFF of the same name was rewritten
+# (e.g. by GRASS or an older script) after the artifact was saved
+def artifact_is_current(outfilepath, outfilename):
+    npyFileName, jsonFileName = artifact_paths(outfilepath, outfilename)
+    if not os.path.isfile(npyFileName) or not os.path.isfile(jsonFileName):
+        return False
+    with open(jsonFileName) as f:
+        meta = json.load(f)
+    geotiffFileName = os.path.join(outfilepath, outfilename)
+    if os.path.isfile(geotiffFileName):
+        return meta['geotiff'] == file_stamp(geotiffFileName)
+    return True
+
+
+# Background writes: a small thread pool (GDAL releases the GIL while
+# encoding and writing) takes arrays to write while the stage computes
+# its next output. Arrays must not be modified once submitted.
+# wait_for_writes() joins them at the end of a stage and re-raises the
+# first failure.
+writeExecutor = None
+pendingWrites = []
+
+
+def submit_write(function, *args, **kwargs):
+    global writeExecutor
+    if defaults.backgroundWriteThreads <= 0:
+        function(*args, **kwargs)
+        return
+    if writeExecutor is None:
+        writeExecutor = ThreadPoolExecutor(defaults.backgroundWriteThreads)
+    pendingWrites.append(writeExecutor.submit(function, *args, **kwargs))
+
+
+def wait_for_writes():
+    while pendingWrites:
+        pendingWrites.pop(0).result()
+
+
+def write_stage_output(inputArray, outfilepath, outfilename,
+                       statistics=None, writer=None, profile=None,
+                       background=False):
+    """
+    Write a stage output with the georeference of profile (default:
+    Parameters): a GeoTIFF through writer (write_geotif_generic by
+    default) unless useArtifactStore is set and doGeotiffExport is not,
+    then the memory-mapped artifact when useArtifactStore is set. Dask
+    arrays only go to the GeoTIFF. With background the numpy array is
+    written by the write queue, see submit_write.
+    """
+    if background and not is_dask_array(inputArray):
+        submit_write(write_stage_output, inputArray, outfilepath,
+                     outfilename, statistics, writer, profile)
+        return
+    if writer is None:
+        writer = write_geotif_generic
+    useArtifact = defaults.useArtifactStore == 1 and \
+        not is_dask_array(inputArray)
+    if not useArtifact or defaults.doGeotiffExport == 1:
+        writer(inputArray, outfilepath, outfilename, statistics=statistics,
+               profile=profile)
+    if useArtifact:
+        print(('writing artifact', os.path.splitext(outfilename)[0]))
+        write_artifact(inputArray, outfilepath, outfilename, profile)
+        if statistics is not None:
+            if statistics is True:
+                statistics = array_statistics(inputArray)
+            write_statistics_sidecar(
+                artifact_paths(outfilepath, outfilename)[0], statistics,
+                blocks=lambda: iter_array_blocks(inputArray))
+
+
+def read_stage_profile(outfilepath, outfilename):
+    """
+    Array and profile of a stage output: the current artifact mapped
+    copy-on-write (in-place edits stay in memory), else the GeoTIFF. With
+    useArtifactStore a GeoTIFF read is saved as an artifact for the next
+    stage that reads it.
+    """
+    if defaults.useArtifactStore == 1 and \
+            artifact_is_current(outfilepath, outfilename):
+        npyFileName, jsonFileName = artifact_paths(outfilepath, outfilename)
+        with open(jsonFileName) as f:
+            meta = json.load(f)
+        profile = RasterProfile(tuple(meta['geotransform']), meta['wkt'],
+                                *meta['shape'])
+        return np.load(npyFileName, mmap_mode='c'), profile
+    fileName = os.path.join(outfilepath, outfilename)
+    ary, profile = read_geotif(fileName)
+    if defaults.useArtifactStore == 1:
+        write_artifact(ary, outfilepath, outfilename, profile,
+                       raster_nodata(fileName))
+    return ary, profile
+
+
+# Array of a stage output, see read_stage_profile
+def read_stage_output(outfilepath, outfilename):
+    return read_stage_profile(outfilepath, outfilename)[0]
+
+
+# stage_statistics of a stage output held in memory, saved to the sidecar
+# of the artifact or GeoTIFF it was read from
+def array_stage_statistics(array, outfilepath, outfilename,
+                           maskFileName=None):
+    if defaults.useArtifactStore == 1 and \
+            artifact_is_current(outfilepath, outfilename):
+        fileName = artifact_paths(outfilepath, outfilename)[0]
+    else:
+        fileName = os.path.join(outfilepath, outfilename)
+    sidecar = read_statistics_sidecar(fileName, maskFileName)
+    if sidecar is not None:
+        print(('using statistics sidecar of', os.path.basename(fileName)))
+        return sidecar
+    print(('computing statistics of', os.path.basename(fileName)))
+    # the band nodata as NaN, as in raster_statistics of the file
+    nodata = raster_nodata(fileName) if os.path.isfile(fileName) else None
+    if nodata is not None and np.isnan(nodata):
+        nodata = None
+    if nodata is not None and is_dask_array(array):
+        array = np.where(array == nodata, np.nan, array)
+        nodata = None
+
+    def blocks():
+        for block in iter_array_blocks(array):
+            yield nodata_to_nan(block, nodata)
+    if nodata is None:
+        statistics = array_statistics(array)
+    else:
+        statistics = RasterStatistics()
+        for block in blocks():
+            statistics.update(block)
+    if os.path.isfile(fileName):
+        write_statistics_sidecar(fileName, statistics, maskFileName, blocks)
+    sidecar = read_statistics_sidecar(fileName, maskFileName)
+    if sidecar is None:
+        sidecar = {'count': statistics.count, 'mean': statistics.mean,
+                   'std': statistics.std, 'min': statistics.min,
+                   'max': statistics.max}
+    return sidecar
+
+
+# Statistics of a stage output: from the sidecar of its current artifact
+# or computed from the mapped artifact, else raster_statistics of the
+# GeoTIFF. With maskFileName only cells valid in that raster count. A
+# stage holding the output in memory passes it as array (already masked
+# like maskFileName); a missing sidecar is then computed from it instead
+# of reading the files again.
+def stage_statistics(outfilepath, outfilename, maskFileName=None,
+                     blockSize=2048, array=None):
+    if array is not None:
+        return array_stage_statistics(array, outfilepath, outfilename,
+                                      maskFileName)
+    if defaults.useArtifactStore != 1 or \
+            not artifact_is_current(outfilepath, outfilename):
+        return raster_statistics(os.path.join(outfilepath, outfilename),
+                                 maskFileName, blockSize)
+    npyFileName = artifact_paths(outfilepath, outfilename)[0]
+    sidecar = read_statistics_sidecar(npyFileName, maskFileName)
+    if sidecar is not None:
+        print(('using statistics sidecar of', os.path.basename(npyFileName)))
+        return sidecar
+    print(('computing statistics of', os.path.basename(npyFileName)))
+    blocks = raster_value_blocks(npyFileName, maskFileName, blockSize)
+    statistics = RasterStatistics()
+    for block in blocks():
+        statistics.update(block)
+    write_statistics_sidecar(npyFileName, statistics, maskFileName, blocks)
+    sidecar = read_statistics_sidecar(npyFileName, maskFileName)
+    if sidecar is None:
+        sidecar = {'count': statistics.count, 'mean': statistics.mean,
+                   'std': statistics.std, 'min': statistics.min,
+                   'max': statistics.max}
+    return sidecar
@@ -1,16 +1,17 @@
 from __future__ import division
 import numpy as np
-import rasterio
-from rasterio import features
 from time import perf_counter 
 from pygeonet_rasterio import *
 from pygeonet_plot import *
+from pygeonet_statistics import curvature_qq_threshold
 
-# Skeleton by thresholding one grid measure e.g. flow or curvature
+# Skeleton by thresholding one grid measure e.g. flow or curvature, as a
+# uint8 mask. Only np.where is used, so dask arrays stay lazy (NEP-18
+# dispatch).
 def compute_skeleton_by_single_threshold(inputArray, threshold):
-    skeletonArray = np.zeros((inputArray.shape))
-    np.warnings.filterwarnings('ignore')
-    skeletonArray[np.where(inputArray > threshold)] = 1
+    with np.errstate(invalid='ignore'):
+        skeletonArray = np.where(inputArray > threshold, np.uint8(1),
+                                 np.uint8(0))
     return skeletonArray
 
 
@@ -19,38 +20,76 @@ def compute_skeleton_by_dual_threshold(inputArray1,
                                        inputArray2,
                                        threshold1,
                                        threshold2):
-    skeletonArray = np.zeros((inputArray1.shape))
-    mask1 = np.where(inputArray1 > threshold1, 1, False)
-    mask2 = np.where(inputArray2 > threshold2, 1, False)
-    skeletonArray = mask1 * mask2
+    with np.errstate(invalid='ignore'):
+        skeletonArray = np.where((inputArray1 > threshold1) &
+                                 (inputArray2 > threshold2),
+                                 np.uint8(1), np.uint8(0))
     return skeletonArray
 
 
 def main():
+    if defaults.useDask == 1:
+        # lazy dask arrays on a local threaded cluster, written chunk-wise
+        with dask_client(defaults.daskThreads):
+            skeleton_definition(defaults.daskChunkSize)
+    else:
+        skeleton_definition()
+    wait_for_writes()
+
+
+# With chunkSize > 0 the rasters are read as dask arrays
+def skeleton_definition(chunkSize=0):
     outfilepath = Parameters.geonetResultsDir
     inputfilepath = Parameters.demDataFilePath
     demName = Parameters.demFileName
     curvature_filename = demName.split('.')[0] + '_curvature.tif'
     fac_filename = demName.split('.')[0] + '_fac.tif'
-    thresholdCurvatureQQxx = 1.5
 #     outlets = [[2, 4, 9], [27, 26, 23]]
-    filteredDemArray = read_geotif_filteredDEM()
-    curvatureDemArray,prj_curv,src_curv = read_geotif_generic(outfilepath, curvature_filename)
-    finiteCurvatureDemList = curvatureDemArray[np.isfinite(
-        curvatureDemArray[:])]
-    curvatureDemMean = np.nanmean(finiteCurvatureDemList)
-    curvatureDemStdDevn = np.nanstd(finiteCurvatureDemList)
+    filteredDemArray, profile = read_geotif(Parameters.pmGrassGISfileName,
+                                            chunkSize)
+    if chunkSize > 0:
+        curvatureDemArray = read_geotif_generic(outfilepath, curvature_filename, chunkSize)[0]
+    else:
+        curvatureDemArray = read_stage_output(outfilepath, curvature_filename)
+    from rasterio.crs import CRS
+    prj_curv = CRS.from_wkt(profile.wktInfo)
+    # from the sidecar written by the slope and curvature stage if fresh,
+    # else from the curvature array already in memory
+    curvatureStatistics = stage_statistics(outfilepath, curvature_filename,
+                                           array=curvatureDemArray)
+    curvatureDemMean = curvatureStatistics['mean']
+    curvatureDemStdDevn = curvatureStatistics['std']
     print('Curvature mean: ', curvatureDemMean)
     print('Curvature standard deviation: ', curvatureDemStdDevn)
     print(f'DEM Projection: {prj_curv}')
+    if defaults.qqCurvatureEstimator == 'fixed':
+        thresholdCurvatureQQxx = defaults.thresholdCurvatureQQxx
+    else:
+        thresholdCurvatureQQxx = curvature_qq_threshold(
+            curvatureDemArray, defaults.qqCurvatureEstimator,
+            defaults.qqSampleFraction, defaults.qqDeviationTolerance,
+            defaults.thresholdCurvatureQQxx)
+    print('Curvature threshold (standard deviations): ',
+          thresholdCurvatureQQxx)
     
 
 
-    flowArray,prj_fac,src_fac = read_geotif_generic(outfilepath, fac_filename)
+    if chunkSize > 0:
+        flowArray = read_geotif_generic(outfilepath, fac_filename, chunkSize)[0]
+    else:
+        flowArray = read_stage_output(outfilepath, fac_filename)
     print("Shape of filteredDemArray:", filteredDemArray.shape)
     print("Shape of flowArray:", flowArray.shape)
-    flowArray[np.isnan(filteredDemArray)] = np.nan
-    flowMean = np.mean(flowArray[~np.isnan(flowArray[:])])
+    # a whole-number FAC is read back as integers, which can't hold NaN
+    if is_dask_array(flowArray) or flowArray.dtype.kind != 'f':
+        flowArray = np.where(np.isnan(filteredDemArray), np.nan, flowArray)
+    else:
+        flowArray[np.isnan(filteredDemArray)] = np.nan
+    # flow statistics over the valid filtered DEM cells, from the masked
+    # flowArray and saved in a sidecar for the fast marching stage
+    flowMean = stage_statistics(outfilepath, fac_filename,
+                                Parameters.pmGrassGISfileName,
+                                array=flowArray)['mean']
     
     print('Mean upstream flow: ', flowMean)
     del filteredDemArray
@@ -71,14 +110,16 @@ def main():
     
     # Writing the skeletonFromCurvatureArray array
     outfilename = demName.split('.')[0]+'_curvatureskeleton.tif'
-    write_geotif_generic(skeletonFromCurvatureArray,
-                         outfilepath, outfilename)
+    write_stage_output(skeletonFromCurvatureArray,
+                       outfilepath, outfilename, profile=profile,
+                       background=True)
     del skeletonFromCurvatureArray
 
     # Writing the skeletonFromFlowArray array
     outfilename = demName.split('.')[0]+'_flowskeleton.tif'
-    write_geotif_generic(skeletonFromFlowArray,
-                         outfilepath, outfilename)
+    write_stage_output(skeletonFromFlowArray,
+                       outfilepath, outfilename, profile=profile,
+                       background=True)
     
     # Define a skeleton based on curvature and flow
     skeletonFromFlowAndCurvatureArray = \
@@ -92,8 +133,9 @@ def main():
 
     # Writing the skeletonFromFlowAndCurvatureArray array
     outfilename = demName.split('.')[0] + '_skeleton.tif'
-    write_geotif_generic(skeletonFromFlowAndCurvatureArray,
-                         outfilepath, outfilename)
+    write_stage_output(skeletonFromFlowAndCurvatureArray,
+                       outfilepath, outfilename, profile=profile,
+                       background=True)
     del skeletonFromFlowAndCurvatureArray
 
 
@@ -1,75 +1,228 @@
 from __future__ import division
 import numpy as np
 np.seterr(divide='ignore', invalid='ignore')
-import statsmodels.api as sm
-import matplotlib.pyplot as plt
-from scipy import stats
 from time import perf_counter 
 from pygeonet_rasterio import *
 from pygeonet_plot import *
+from pygeonet_statistics import RasterStatistics, array_statistics, \
+    iter_array_blocks
+from pygeonet_derivatives import (slope_magnitude, dem_derivatives,
+                                  second_derivatives, surface_curvature,
+                                  dem_curvature, DerivativeCache,
+                                  SURFACE_CURVATURES)
 
 
-def compute_dem_slope(filteredDemArray, pixelDemScale):
-    slopeYArray, slopeXArray = np.gradient(filteredDemArray, pixelDemScale)
-    slopeDemArray = np.sqrt(slopeXArray**2 + slopeYArray**2)
-    slopeMagnitudeDemArrayQ = slopeDemArray
-    slopeMagnitudeDemArrayQ = np.reshape(slopeMagnitudeDemArrayQ,
-                                         np.size(slopeMagnitudeDemArrayQ))
-    slopeMagnitudeDemArrayQ = slopeMagnitudeDemArrayQ[
-        ~np.isnan(slopeMagnitudeDemArrayQ)]
+def compute_dem_slope(filteredDemArray, pixelDemScale, slopeDemArray=None):
+    # slopeDemArray can be passed in when already computed by dem_derivatives.
+    # A dask filteredDemArray gives a dask slope array, computed once and
+    # persisted for the statistics passes and the write.
+    if slopeDemArray is None and is_dask_array(filteredDemArray):
+        # 1 pixel halo for the central differences
+        slopeDemArray = filteredDemArray.map_overlap(
+            slope_magnitude, depth=1, boundary='none', dtype='float32',
+            pixelDemScale=pixelDemScale).persist()
+    elif slopeDemArray is None:
+        slopeDemArray = slope_magnitude(filteredDemArray, pixelDemScale)
     # Computation of statistics of slope
-    print(' slope statistics')
-    print(' angle min:', np.arctan(np.percentile(slopeMagnitudeDemArrayQ,
-                                                 0.1))*180/np.pi)
-    print(' angle max:', np.arctan(np.percentile(slopeMagnitudeDemArrayQ,
-                                                 99.9))*180/np.pi)
-    print(' mean slope:', np.nanmean(slopeDemArray[:]))
-    print(' stdev slope:', np.nanstd(slopeDemArray[:]))
+    slopeStatistics = array_statistics(slopeDemArray)
+    print_slope_statistics(slopeStatistics,
+                           lambda: iter_array_blocks(slopeDemArray))
     return slopeDemArray
 
 
-def compute_dem_curvature(demArray, pixelDemScale, curvatureCalcMethod):
-    # OLD:
-    #gradXArray, gradYArray = np.gradient(demArray, pixelDemScale)
-    # NEW: 
-    gradYArray, gradXArray = np.gradient(demArray, pixelDemScale)
-    
-    slopeArrayT = np.sqrt(gradXArray**2 + gradYArray**2)
+# blocks() yields the slope values again for exact percentiles
+def print_slope_statistics(slopeStatistics, blocks):
+    angleMin, angleMax = slopeStatistics.exact_percentiles(blocks,
+                                                           [0.1, 99.9])
+    print(' slope statistics')
+    print(' angle min:', np.arctan(angleMin)*180/np.pi)
+    print(' angle max:', np.arctan(angleMax)*180/np.pi)
+    print(' mean slope:', slopeStatistics.mean)
+    print(' stdev slope:', slopeStatistics.std)
+
+
+def print_curvature_statistics(curvatureStatistics):
+    print(' curvature statistics')
+    print(' non-nan finite curvature cell number:', curvatureStatistics.count)
+    print(' mean: ', curvatureStatistics.mean)
+    print(' standard deviation: ', curvatureStatistics.std)
+
+
+def compute_dem_curvature(demArray, pixelDemScale, curvatureCalcMethod,
+                          derivatives=None, derivativeCache=None):
+    # derivatives: (slope, geometric, laplacian) from dem_derivatives,
+    # computed here in a single fused pass if not given. Profile, plan and
+    # tangential curvature come from derivativeCache when given. A dask
+    # demArray gives a dask curvature array, persisted like the slope.
+    if is_dask_array(demArray):
+        print((' using', curvatureCalcMethod, 'curvature'))
+        # the gradient is needed one pixel beyond each chunk: 2 pixel halo
+        curvatureDemArray = demArray.map_overlap(
+            dem_curvature, depth=2, boundary='none', dtype='float32',
+            pixelDemScale=pixelDemScale, method=curvatureCalcMethod)
+        curvatureDemArray = np.where(np.isnan(curvatureDemArray), 0,
+                                     curvatureDemArray).persist()
+        curvatureStatistics = array_statistics(curvatureDemArray,
+                                               histogram=False)
+        print_curvature_statistics(curvatureStatistics)
+        return (curvatureDemArray, curvatureStatistics.mean,
+                curvatureStatistics.std)
+    if curvatureCalcMethod in SURFACE_CURVATURES:
+        print((' using', curvatureCalcMethod, 'curvature'))
+        if derivativeCache is not None:
+            curvatureDemArray = derivativeCache.curvature(curvatureCalcMethod)
+        else:
+            curvatureDemArray = surface_curvature(
+                second_derivatives(demArray, pixelDemScale),
+                curvatureCalcMethod)
+        derivatives = (None, None, None)
+    elif derivatives is None:
+        derivatives = dem_derivatives(demArray, pixelDemScale)
+    slopeArrayT, geometricArray, laplacianArray = derivatives
     if curvatureCalcMethod == 'geometric':
         # Geometric curvature
         print(' using geometric curvature')
-        gradXArrayT = np.divide(gradXArray, slopeArrayT)
-        gradYArrayT = np.divide(gradYArray, slopeArrayT)
+        curvatureDemArray = geometricArray
     elif curvatureCalcMethod == 'laplacian':
-        # do nothing..
         print(' using laplacian curvature')
-        gradXArrayT = gradXArray
-        gradYArrayT = gradYArray
-    
-    
-    # NEW:
-    tmpy, gradGradXArray = np.gradient(gradXArrayT, pixelDemScale)
-    gradGradYArray, tmpx = np.gradient(gradYArrayT, pixelDemScale)
-
-    curvatureDemArray = gradGradXArray + gradGradYArray
+        curvatureDemArray = laplacianArray
+
     curvatureDemArray[np.isnan(curvatureDemArray)] = 0
-    del tmpy, tmpx
     # Computation of statistics of curvature
-    print(' curvature statistics')
-    tt = curvatureDemArray[~np.isnan(curvatureDemArray[:])]
-    print(' non-nan curvature cell number:', tt.shape[0])
-    finiteCurvatureDemList = curvatureDemArray[np.isfinite(
-        curvatureDemArray[:])]
-    print(' non-nan finite curvature cell number:', end=' ')
-    finiteCurvatureDemList.shape[0]
-    curvatureDemMean = np.nanmean(finiteCurvatureDemList)
-    curvatureDemStdDevn = np.nanstd(finiteCurvatureDemList)
-    print(' mean: ', curvatureDemMean)
-    print(' standard deviation: ', curvatureDemStdDevn)
-    return curvatureDemArray, curvatureDemMean, curvatureDemStdDevn
+    curvatureStatistics = array_statistics(curvatureDemArray,
+                                           histogram=False)
+    print_curvature_statistics(curvatureStatistics)
+    return (curvatureDemArray, curvatureStatistics.mean,
+            curvatureStatistics.std)
+
+
+def compute_slope_curvature_blocks(inFileName, slopeFileName,
+                                   curvatureFileName, curvatureCalcMethod,
+                                   blockSize):
+    # Slope and curvature of a geotiff block by block, written straight
+    # into tiled geotiffs. Curvature needs the gradient one pixel beyond
+    # the block, hence a 2 pixel halo; the block cores are then identical
+    # to the whole-DEM computation. Only the running statistics of both
+    # outputs are kept, so memory stays at a few blocks.
+    srcDs = gdal.Open(inFileName, gdal.GA_ReadOnly)
+    pixelScale = raster_profile(srcDs).pixelScale
+    slopeDs = create_geotif_from_dataset(srcDs, slopeFileName)
+    curvatureDs = create_geotif_from_dataset(srcDs, curvatureFileName)
+    del srcDs
+    slopeBand = slopeDs.GetRasterBand(1)
+    curvatureBand = curvatureDs.GetRasterBand(1)
+    slopeStatistics = RasterStatistics()
+    curvatureStatistics = RasterStatistics(histogram=False)
+    # statistics of the written rasters, for their sidecars
+    slopeFileStatistics = RasterStatistics()
+    curvatureFileStatistics = RasterStatistics()
+    buffers = {}
+    print((' using', curvatureCalcMethod, 'curvature'))
+    for window, block in iter_geotif_windows(inFileName, blockSize, 2):
+        # derivative buffers are reused between blocks of the same shape
+        if block.shape not in buffers:
+            buffers[block.shape] = (
+                tuple(np.empty(block.shape, 'float32') for _ in range(3)),
+                tuple(np.empty(block.shape, 'float32') for _ in range(2)))
+        out, work = buffers[block.shape]
+        if curvatureCalcMethod in SURFACE_CURVATURES:
+            derivatives = second_derivatives(block, pixelScale)
+            slope = np.hypot(derivatives[0], derivatives[1])
+            curvature = surface_curvature(derivatives, curvatureCalcMethod,
+                                          out[1])
+            del derivatives
+        else:
+            slope, geometric, laplacian = dem_derivatives(
+                block, pixelScale, out=out, work=work)
+            if curvatureCalcMethod == 'geometric':
+                curvature = geometric
+            else:
+                curvature = laplacian
+        curvature[np.isnan(curvature)] = 0
+        slope = window_core(slope, window)
+        curvature = window_core(curvature, window)
+        # statistics as in compute_dem_slope and compute_dem_curvature,
+        # i.e. before masking the DEM nodata cells
+        slopeStatistics.update(slope)
+        curvatureStatistics.update(curvature)
+        demNan = np.isnan(window_core(block, window))
+        slope[demNan] = np.nan
+        curvature[demNan] = np.nan
+        slopeBand.WriteArray(slope, window.xoff, window.yoff)
+        curvatureBand.WriteArray(curvature, window.xoff, window.yoff)
+        slopeFileStatistics.update(slope)
+        curvatureFileStatistics.update(curvature)
+    set_band_statistics(slopeBand, None, slopeFileStatistics)
+    set_band_statistics(curvatureBand, None, curvatureFileStatistics)
+    slopeBand.FlushCache()
+    curvatureBand.FlushCache()
+    del slopeBand, curvatureBand, slopeDs, curvatureDs
+    finish_geotif(slopeFileName)
+    finish_geotif(curvatureFileName)
+    write_statistics_sidecar(slopeFileName, slopeFileStatistics)
+    write_statistics_sidecar(curvatureFileName, curvatureFileStatistics)
+
+    # the slope of every block again, for exact percentiles
+    def slope_blocks():
+        for window, block in iter_geotif_windows(inFileName, blockSize, 2):
+            if curvatureCalcMethod in SURFACE_CURVATURES:
+                derivatives = second_derivatives(block, pixelScale)
+                slope = np.hypot(derivatives[0], derivatives[1])
+            else:
+                slope = slope_magnitude(block, pixelScale)
+            yield window_core(slope, window)
+    print_slope_statistics(slopeStatistics, slope_blocks)
+    print_curvature_statistics(curvatureStatistics)
+    return curvatureStatistics.mean, curvatureStatistics.std
+
+
+def main_blocks():
+    # georeference of the filtered DEM without reading its pixels
+    ds = gdal.Open(Parameters.pmGrassGISfileName, gdal.GA_ReadOnly)
+    set_parameters_profile(raster_profile(ds))
+    del ds
+    outfilepath = Parameters.geonetResultsDir
+    demName = Parameters.demFileName.split('.')[0]
+    print('computing slope and curvature block by block')
+    compute_slope_curvature_blocks(
+        Parameters.pmGrassGISfileName,
+        os.path.join(outfilepath, demName + '_slope.tif'),
+        os.path.join(outfilepath, demName + '_curvature.tif'),
+        defaults.curvatureCalcMethod, defaults.slopeCurvatureBlockSize)
+
+
+def main_dask():
+    # Dask arrays on a local threaded cluster. Slope and curvature are
+    # computed chunk-wise once and persisted in the cluster's memory, so
+    # the statistics and the masked writes read them instead of computing
+    # them again
+    with dask_client(defaults.daskThreads):
+        filteredDemArray, profile = read_geotif(
+            Parameters.pmGrassGISfileName, defaults.daskChunkSize)
+        # the nodata mask is kept too rather than read again for each write
+        demNan = np.isnan(filteredDemArray).persist()
+        outfilepath = Parameters.geonetResultsDir
+        demName = Parameters.demFileName.split('.')[0]
+        print('computing slope')
+        slopeDemArray = compute_dem_slope(filteredDemArray,
+                                          profile.pixelScale)
+        write_geotif_generic(np.where(demNan, np.nan, slopeDemArray),
+                             outfilepath, demName + '_slope.tif',
+                             statistics=True, profile=profile)
+        del slopeDemArray
+        print('computing curvature')
+        curvatureDemArray = compute_dem_curvature(
+            filteredDemArray, profile.pixelScale,
+            defaults.curvatureCalcMethod)[0]
+        write_geotif_generic(np.where(demNan, np.nan, curvatureDemArray),
+                             outfilepath, demName + '_curvature.tif',
+                             statistics=True, profile=profile)
 
 
 def compute_quantile_quantile_curve(x):
+    import statsmodels.api as sm
+    from scipy import stats
+    import matplotlib.pyplot as plt
     print('getting qqplot estimate')
     if not hasattr(defaults, 'figureNumber'):
         defaults.figureNumber = 0
@@ -82,37 +235,60 @@ def compute_quantile_quantile_curve(x):
 
  
 def main():
+    if defaults.useDask == 1:
+        main_dask()
+        return
+    if defaults.slopeCurvatureBlockSize > 0:
+        main_blocks()
+        return
     # plt.switch_backend('agg')
-    filteredDemArray = read_geotif_filteredDEM()
+    filteredDemArray, profile = read_geotif(Parameters.pmGrassGISfileName)
+    pixelScale = profile.pixelScale
+    outfilepath = Parameters.geonetResultsDir
+    demName = Parameters.demFileName.split('.')[0]
+    if defaults.curvatureCalcMethod in SURFACE_CURVATURES:
+        # second derivatives cached per filtered DEM, so switching between
+        # profile, plan and tangential curvature doesn't recompute them
+        derivatives = None
+        derivativeCache = DerivativeCache(
+            os.path.join(outfilepath, demName + '_derivatives'),
+            Parameters.pmGrassGISfileName)
+        derivativeCache.update(filteredDemArray, pixelScale)
+        slopeDemArray = derivativeCache.slope()
+    else:
+        # Slope and both curvatures in one pass over the DEM
+        derivativeCache = None
+        derivatives = dem_derivatives(filteredDemArray, pixelScale)
+        slopeDemArray = derivatives[0]
     # Computing slope
     print('computing slope')
-    slopeDemArray = compute_dem_slope(filteredDemArray,
-                                      Parameters.demPixelScale)
+    slopeDemArray = compute_dem_slope(filteredDemArray, pixelScale,
+                                      slopeDemArray)
     slopeDemArray[np.isnan(filteredDemArray)] = np.nan
     # Writing the curvature array
-    outfilepath = Parameters.geonetResultsDir
-    demName = Parameters.demFileName.split('.')[0]
     outfilename = demName + '_slope.tif'
-    write_geotif_generic(slopeDemArray, outfilepath, outfilename)
+    write_stage_output(slopeDemArray, outfilepath, outfilename,
+                       statistics=True, profile=profile, background=True)
     # Computing curvature
     print('computing curvature')
 #     curvatureDemArrayIn = filteredDemArray
     print(np.max(filteredDemArray))
     curvatureDemArray, curvatureDemMean, \
                        curvatureDemStdDevn = compute_dem_curvature(
-                           filteredDemArray, Parameters.demPixelScale,
-                           defaults.curvatureCalcMethod)
+                           filteredDemArray, pixelScale,
+                           defaults.curvatureCalcMethod, derivatives,
+                           derivativeCache)
     curvatureDemArray[np.isnan(filteredDemArray)] = np.nan
     # Writing the curvature array
     outfilename = demName + '_curvature.tif'
-    write_geotif_generic(curvatureDemArray, outfilepath, outfilename)
+    write_stage_output(curvatureDemArray, outfilepath, outfilename,
+                       statistics=True, profile=profile, background=True)
     # plotting the curvature image
     #if defaults.doPlot == 1:
     #    raster_plot(curvatureDemArray, 'Curvature DEM')
 
-    finiteCurvatureDemList = curvatureDemArray[np.isfinite(
-        curvatureDemArray[:])]
     thresholdCurvatureQQxx = 1
+    wait_for_writes()
 
 if __name__ == '__main__':
     t0 = perf_counter()
@@ -0,0 +1,414 @@
+# PyGeoNet functions for block-wise (out-of-core) raster statistics
+import numpy as np
+
+
+class HistogramQuantileSketch(object):
+    """
+    Fixed-memory histogram of a stream of values for approximate quantiles.
+    The histogram covers [lo, lo + nbins*width); when a block falls outside
+    it the bin width doubles and adjacent bins merge, so blocks can be
+    added in any order and sketches of separate blocks can be merged.
+    Quantiles are accurate to one bin width, which a few outliers can
+    stretch over the whole bulk of the data; exact_rank_values refines
+    them with further passes over the values.
+    """
+
+    def __init__(self, nbins=65536):
+        self.nbins = nbins - nbins % 2
+        self.counts = np.zeros(self.nbins, dtype='int64')
+        self.lo = None
+        self.width = None
+
+    def _expand(self, vmin, vmax):
+        if self.lo is None:
+            self.lo = float(vmin)
+            span = float(vmax) - float(vmin)
+            self.width = span/(self.nbins-1) if span > 0 else \
+                max(abs(self.lo)*1e-6, 1e-12)
+        half = self.nbins//2
+        while vmin < self.lo:
+            merged = self.counts.reshape(half, 2).sum(axis=1)
+            self.counts[:half] = 0
+            self.counts[half:] = merged
+            self.lo -= self.nbins*self.width
+            self.width *= 2
+        while vmax >= self.lo + self.nbins*self.width:
+            merged = self.counts.reshape(half, 2).sum(axis=1)
+            self.counts[half:] = 0
+            self.counts[:half] = merged
+            self.width *= 2
+
+    def bin_index(self, values):
+        index = np.floor((values - self.lo)/self.width).astype('int64')
+        return np.clip(index, 0, self.nbins-1)
+
+    def update(self, values):
+        values = np.asarray(values).ravel()
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+        self._expand(values.min(), values.max())
+        self.counts += np.bincount(self.bin_index(values),
+                                   minlength=self.nbins)
+
+    def merge(self, other):
+        if other.lo is None:
+            return
+        if other.nbins != self.nbins:
+            raise ValueError('Cannot merge sketches with different nbins')
+        if self.lo is None:
+            self.lo, self.width = other.lo, other.width
+            self.counts = other.counts.copy()
+            return
+        # re-add the other histogram at its bin centres
+        centres = other.lo + other.width*(np.arange(other.nbins)+0.5)
+        used = other.counts > 0
+        self._expand(centres[used].min(), centres[used].max())
+        self.counts += np.bincount(self.bin_index(centres[used]),
+                                   weights=other.counts[used],
+                                   minlength=self.nbins).astype('int64')
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def rank_bin(self, rank):
+        # bin holding the value of 0-based rank
+        cumulative = np.cumsum(self.counts)
+        return int(np.searchsorted(cumulative, rank, side='right'))
+
+    def rank_interval(self, rank):
+        # value range of the bin holding the value of 0-based rank, with
+        # one bin margin on each side for values on a bin edge
+        b = self.rank_bin(rank)
+        return (self.lo + self.width*max(b-1, 0),
+                self.lo + self.width*min(b+2, self.nbins))
+
+    def quantile(self, prob, alphap=.4, betap=.4):
+        # Same plotting positions as scipy.stats.mstats.mquantiles, with
+        # values spread uniformly inside each bin
+        n = self.count
+        if n == 0:
+            return np.nan
+        rank = mquantiles_rank(n, prob, alphap, betap)
+        cumulative = np.cumsum(self.counts)
+        b = int(np.searchsorted(cumulative, rank, side='right'))
+        below = cumulative[b-1] if b > 0 else 0
+        fraction = (rank - below + 0.5)/self.counts[b]
+        return self.lo + self.width*(b + fraction)
+
+
+class RasterStatistics(object):
+    """
+    Single-pass statistics of the finite values of a raster, fed block by
+    block: count, mean and M2 (sum of squared deviations) with Welford's
+    update, min, max and optionally a HistogramQuantileSketch for
+    percentiles. Accumulators of separate blocks or processes combine
+    with merge, so no filtered copy of the raster is ever needed.
+    """
+
+    def __init__(self, nbins=65536, histogram=True):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self.sketch = HistogramQuantileSketch(nbins) if histogram else None
+
+    def _combine(self, count, mean, m2, vmin, vmax):
+        # Chan et al. pairwise form of the Welford update
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta*count/total
+        self.m2 += m2 + delta**2*self.count*count/total
+        self.count = total
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+
+    def update(self, values, mask=None):
+        # add the finite values of a block, restricted to mask if given
+        values = np.asarray(values)
+        valid = np.isfinite(values)
+        if mask is not None:
+            valid &= mask
+        count = int(np.count_nonzero(valid))
+        if count == 0:
+            return
+        mean = np.sum(values, where=valid, dtype='float64')/count
+        m2 = np.sum(np.square(values - mean, dtype='float64'), where=valid)
+        self._combine(count, mean, m2,
+                      float(np.min(values, where=valid, initial=np.inf)),
+                      float(np.max(values, where=valid, initial=-np.inf)))
+        if self.sketch is not None:
+            self.sketch.update(values if mask is None else values[valid])
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self._combine(other.count, other.mean, other.m2, other.min,
+                      other.max)
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+
+    @property
+    def variance(self):
+        # population variance, as np.nanvar
+        return self.m2/self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.variance))
+
+    def percentile(self, q):
+        # linear interpolation percentile (np.percentile), to one bin width
+        if self.sketch is None:
+            raise ValueError('percentiles need RasterStatistics with a'
+                             ' histogram')
+        return self.sketch.quantile(q/100., 1., 1.)
+
+    def exact_percentiles(self, blocks, qs):
+        # np.percentile of each of qs, exact: blocks() yields again the
+        # values that were fed to update (masked the same way) for
+        # exact_rank_values to resolve the sketch bins
+        if self.sketch is None:
+            raise ValueError('percentiles need RasterStatistics with a'
+                             ' histogram')
+        if self.count == 0:
+            return [np.nan for q in qs]
+        ranks = [mquantiles_rank(self.count, q/100., 1., 1.) for q in qs]
+        intervals = {}
+        for rank in ranks:
+            k = int(np.floor(rank))
+            for r in (k, min(k+1, self.count-1)):
+                intervals[r] = self.sketch.rank_interval(r)
+        values = exact_rank_values(blocks, intervals)
+        percentiles = []
+        for rank in ranks:
+            k = int(np.floor(rank))
+            gamma = rank - k
+            percentiles.append(float((1.-gamma)*values[k] + gamma*values[
+                min(k+1, self.count-1)]))
+        return percentiles
+
+
+# Fractional 0-based rank of the quantile prob in a sample of size n, as
+# used by scipy.stats.mstats.mquantiles
+def mquantiles_rank(n, prob, alphap=.4, betap=.4):
+    m = alphap + prob*(1.-alphap-betap)
+    aleph = n*prob + m
+    k = np.floor(np.clip(aleph, 1, n-1))
+    gamma = np.clip(aleph-k, 0, 1)
+    return k - 1 + gamma
+
+
+def exact_rank_values(blocks, intervals, nbins=4096, maxCandidates=2**20):
+    """
+    Exact values of 0-based ranks among the finite values yielded by
+    blocks(), a callable returning a fresh iterator of arrays, given
+    intervals {rank: (lo, hi)} known to hold them (see
+    HistogramQuantileSketch.rank_interval). Every pass counts the values
+    below each interval and histograms those inside it. An interval with
+    at most maxCandidates values inside is resolved by partitioning them;
+    any other narrows to the bins around its rank for the next pass, so
+    outliers cost passes rather than accuracy and memory stays bounded.
+    """
+    intervals = dict(intervals)
+    values = {}
+    # intervals too narrow to split further (float resolution) keep all
+    # their values
+    keepAll = set()
+    while intervals:
+        keepAll.update(k for k, (lo, hi) in intervals.items()
+                       if not (hi - lo)/nbins > 0)
+        below = dict.fromkeys(intervals, 0)
+        inside = dict.fromkeys(intervals, 0)
+        vmin = dict.fromkeys(intervals, np.inf)
+        vmax = dict.fromkeys(intervals, -np.inf)
+        counts = {k: np.zeros(nbins, dtype='int64') for k in intervals}
+        candidates = {k: [] for k in intervals}
+        for block in blocks():
+            block = np.asarray(block, dtype='float64').ravel()
+            block = block[np.isfinite(block)]
+            for k, (lo, hi) in intervals.items():
+                below[k] += int(np.count_nonzero(block < lo))
+                found = block[(block >= lo) & (block <= hi)]
+                if found.size == 0:
+                    continue
+                inside[k] += found.size
+                vmin[k] = min(vmin[k], found.min())
+                vmax[k] = max(vmax[k], found.max())
+                if k not in keepAll:
+                    index = np.floor((found - lo)/((hi - lo)/nbins))
+                    counts[k] += np.bincount(
+                        np.clip(index, 0, nbins-1).astype('int64'),
+                        minlength=nbins)
+                if candidates[k] is None:
+                    continue
+                if inside[k] > maxCandidates and k not in keepAll:
+                    candidates[k] = None
+                else:
+                    candidates[k].append(found)
+        for k, (lo, hi) in list(intervals.items()):
+            if vmin[k] == vmax[k]:
+                # a single value (e.g. a flat area) holds the rank
+                values[k] = float(vmin[k])
+            elif candidates[k] is not None:
+                kLocal = k - below[k]
+                values[k] = float(np.partition(
+                    np.concatenate(candidates[k]), kLocal)[kLocal])
+            else:
+                b = int(np.searchsorted(below[k] + np.cumsum(counts[k]), k,
+                                        side='right'))
+                width = (hi - lo)/nbins
+                # one bin margin on each side absorbs values on a bin edge
+                narrowed = (max(vmin[k], lo + width*(b-1)),
+                            min(vmax[k], lo + width*(b+2)))
+                if narrowed == (lo, hi):
+                    keepAll.add(k)
+                else:
+                    intervals[k] = narrowed
+                continue
+            del intervals[k]
+    return values
+
+
+def exact_quantile_two_pass(blocks, prob, nbins=65536, alphap=.4, betap=.4):
+    """
+    Exact mquantiles of all values yielded by blocks(), a callable
+    returning a fresh iterator of arrays. The first pass builds a
+    histogram sketch; the next keep only the values in the bins around
+    the requested ranks (see exact_rank_values), so memory is bounded by
+    a few bins.
+    """
+    sketch = HistogramQuantileSketch(nbins)
+    for block in blocks():
+        sketch.update(block)
+    n = sketch.count
+    if n == 0:
+        return np.nan
+    rank = mquantiles_rank(n, prob, alphap, betap)
+    k = int(np.floor(rank))
+    gamma = rank - k
+    kNext = min(k+1, n-1)
+    values = exact_rank_values(blocks, {r: sketch.rank_interval(r)
+                                        for r in (k, kNext)})
+    return float((1.-gamma)*values[k] + gamma*values[kNext])
+
+
+# Dask arrays are handled without importing dask unless one is passed in
+def is_dask_array(array):
+    return type(array).__module__.split('.')[0] == 'dask'
+
+
+# func applied to every chunk of a dask array (in parallel, on the active
+# scheduler), or to a numpy array as a single chunk
+def map_chunks(func, array):
+    if not is_dask_array(array):
+        return [func(array)]
+    import dask
+    return list(dask.compute(*[dask.delayed(func)(chunk)
+                               for chunk in array.to_delayed().ravel()]))
+
+
+# Row blocks of about blockPixels values of a numpy array, so the float64
+# temporaries of RasterStatistics.update stay small next to the array
+def iter_row_blocks(array, blockPixels=2**20):
+    rowSize = max(int(np.prod(array.shape[1:])), 1)
+    blockRows = max(blockPixels//rowSize, 1)
+    for r0 in range(0, max(array.shape[0], 1), blockRows):
+        yield array[r0:r0+blockRows]
+
+
+# Blocks of a numpy or dask array for a further pass over its values: row
+# blocks, or the dask chunks computed one at a time
+def iter_array_blocks(array):
+    if not is_dask_array(array):
+        return iter_row_blocks(array)
+    return (chunk.compute() for chunk in array.to_delayed().ravel())
+
+
+# RasterStatistics of a numpy or dask array, chunk by chunk (row block by
+# row block for numpy) and merged
+def array_statistics(array, histogram=True):
+    def chunk_statistics(chunk):
+        statistics = RasterStatistics(histogram=histogram)
+        for block in iter_row_blocks(np.asarray(chunk)):
+            statistics.update(block)
+        return statistics
+    parts = map_chunks(chunk_statistics, array)
+    statistics = parts[0]
+    for part in parts[1:]:
+        statistics.merge(part)
+    return statistics
+
+
+# Random subsample of the finite values of array with the same fraction
+# drawn from every strataSize x strataSize block, so all parts of the
+# raster are represented
+def stratified_subsample(array, fraction, strataSize=256, seed=0):
+    rng = np.random.default_rng(seed)
+    samples = []
+    for r0 in range(0, array.shape[0], strataSize):
+        for c0 in range(0, array.shape[1], strataSize):
+            block = array[r0:r0+strataSize, c0:c0+strataSize]
+            block = block[np.isfinite(block)]
+            nsample = int(round(block.size*fraction))
+            if nsample > 0:
+                samples.append(rng.choice(block, nsample, replace=False))
+    if not samples:
+        return np.empty(0)
+    return np.concatenate(samples)
+
+
+def qq_deviation_point(probs, quantiles, mean, std, fitRange=1.,
+                       tolerance=0.1):
+    """
+    Point where the upper tail of a normal quantile-quantile curve leaves
+    the straight line. quantiles of the data at probabilities probs are
+    standardized with mean and std and plotted against the normal
+    quantiles; a line is fitted where the normal quantile is within
+    +-fitRange. Returns the standardized data value of the first point of
+    the upper half lying more than tolerance above the line, i.e. the
+    threshold in standard deviations, or None if the tail stays on it.
+    """
+    from scipy.stats import norm
+    theoretical = norm.ppf(probs)
+    observed = (np.asarray(quantiles, dtype='float64') - mean)/std
+    central = np.abs(theoretical) <= fitRange
+    slope, intercept = np.polyfit(theoretical[central], observed[central], 1)
+    residual = observed - (slope*theoretical + intercept)
+    deviating = np.flatnonzero((theoretical > 0) & (residual > tolerance))
+    if deviating.size == 0:
+        return None
+    return float(observed[deviating[0]])
+
+
+# Curvature threshold in standard deviations above the mean from the QQ
+# deviation point, estimated from a stratified subsample ('subsample') or
+# from the binned CDF of a histogram sketch of all cells ('binned')
+def curvature_qq_threshold(curvatureArray, estimator='binned',
+                           sampleFraction=0.01, tolerance=0.1,
+                           default=1.5, nprobs=1000):
+    # curvatureArray can be a numpy or a dask array
+    probs = (np.arange(nprobs)+0.5)/nprobs
+    if estimator == 'subsample':
+        sample = np.concatenate(map_chunks(
+            lambda chunk: stratified_subsample(chunk, sampleFraction),
+            curvatureArray))
+        if sample.size < 2:
+            return default
+        quantiles = np.quantile(sample, probs)
+        mean, std = sample.mean(), sample.std()
+    elif estimator == 'binned':
+        statistics = array_statistics(curvatureArray)
+        if statistics.count < 2:
+            return default
+        quantiles = [statistics.sketch.quantile(p, 1., 1.) for p in probs]
+        mean, std = statistics.mean, statistics.std
+    else:
+        raise ValueError('unknown qq estimator ' + str(estimator))
+    if std == 0:
+        return default
+    threshold = qq_deviation_point(probs, quantiles, mean, std,
+                                   tolerance=tolerance)
+    return default if threshold is None else threshold
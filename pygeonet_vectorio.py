@@ -4,6 +4,19 @@ from osgeo import ogr
 from osgeo import osr
 from osgeo import gdal
 import pygeonet_prepare as Parameters
+from pygeonet_rasterio import (raster_metadata, cached_srs,
+                               parameters_profile, set_parameters_profile)
+
+
+# Geotransform and spatial reference of the shapefiles: those last read
+# into Parameters, else the input DEM's from the dataset cache
+def output_georeference():
+    if not hasattr(Parameters, 'geotransform'):
+        fullFilePath = os.path.join(Parameters.demDataFilePath,
+                                    Parameters.demFileName)
+        set_parameters_profile(raster_metadata(fullFilePath).profile)
+    profile = parameters_profile()
+    return profile.geotransform, cached_srs(profile.wktInfo)
 
 
 # Writing drainage network node (head/junction) shapefiles
@@ -17,17 +30,7 @@ def write_drainage_nodes(xx, yy, node_type, fileName, shapeName):
     # create the data source
     data_source = driver.CreateDataSource(fileName)
     # create the spatial reference, same as the input dataset
-    if not hasattr(Parameters, 'geotransform'):
-        fullFilePath = os.path.join(Parameters.demDataFilePath,
-                                    Parameters.demFileName)
-        ds = gdal.Open(fullFilePath, gdal.GA_ReadOnly)
-        geotransform = ds.GetGeoTransform()
-        Parameters.geotransform = geotransform
-        Parameters.inputwktInfo = ds.GetProjection()
-    srs = osr.SpatialReference()
-    gtf = Parameters.geotransform
-    georef = Parameters.inputwktInfo
-    srs.ImportFromWkt(georef)
+    gtf, srs = output_georeference()
     # Project the xx, and yy points
     xxProj = (float(gtf[0]) +
               float(gtf[1]) * np.array(xx))
@@ -71,17 +74,7 @@ def write_drainage_paths(geodesicPathsCellList):
     if os.path.exists(Parameters.drainagelineFileName):
         driver.DeleteDataSource(Parameters.drainagelineFileName)
     data_source = driver.CreateDataSource(Parameters.drainagelineFileName)
-    if not hasattr(Parameters, 'geotransform'):
-        fullFilePath = os.path.join(Parameters.demDataFilePath,
-                                    Parameters.demFileName)
-        ds = gdal.Open(fullFilePath, gdal.GA_ReadOnly)
-        geotransform = ds.GetGeoTransform()
-        Parameters.geotransform = geotransform
-        Parameters.inputwktInfo = ds.GetProjection()
-    srs = osr.SpatialReference()
-    gtf = Parameters.geotransform
-    georef = Parameters.inputwktInfo
-    srs.ImportFromWkt(georef)
+    gtf, srs = output_georeference()
     layer = data_source.CreateLayer(Parameters.drainagelinefileName,
                                     srs, ogr.wkbLineString)
     field_name = ogr.FieldDefn("Type", ogr.OFTString)
@@ -123,17 +116,7 @@ def write_cross_sections(TotalcrossSectionsXYArray, XSIDArray):
     if os.path.exists(Parameters.xsFileName):
         driver.DeleteDataSource(Parameters.xsFileName)
     data_source = driver.CreateDataSource(Parameters.xsFileName)
-    if not hasattr(Parameters, 'geotransform'):
-        fullFilePath = os.path.join(Parameters.demDataFilePath,
-                                    Parameters.demFileName)
-        ds = gdal.Open(fullFilePath, gdal.GA_ReadOnly)
-        geotransform = ds.GetGeoTransform()
-        Parameters.geotransform = geotransform
-        Parameters.inputwktInfo = ds.GetProjection()
-    srs = osr.SpatialReference()
-    gtf = Parameters.geotransform
-    georef = Parameters.inputwktInfo
-    srs.ImportFromWkt(georef)
+    gtf, srs = output_georeference()
     layer = data_source.CreateLayer(Parameters.xsshapefileName,
                                     srs, ogr.wkbLineString)
     field_name = ogr.FieldDefn("Type", ogr.OFTString)
@@ -166,17 +149,7 @@ def write_bank_lines(leftBankCellList, rightBankCellList):
     if os.path.exists(Parameters.banklineFileName):
         driver.DeleteDataSource(Parameters.banklineFileName)
     data_source = driver.CreateDataSource(Parameters.banklineFileName)
-    if not hasattr(Parameters, 'geotransform'):
-        fullFilePath = os.path.join(Parameters.demDataFilePath,
-                                    Parameters.demFileName)
-        ds = gdal.Open(fullFilePath, gdal.GA_ReadOnly)
-        geotransform = ds.GetGeoTransform()
-        Parameters.geotransform = geotransform
-        Parameters.inputwktInfo = ds.GetProjection()
-    srs = osr.SpatialReference()
-    gtf = Parameters.geotransform
-    georef = Parameters.inputwktInfo
-    srs.ImportFromWkt(georef)
+    gtf, srs = output_georeference()
     layer = data_source.CreateLayer(Parameters.banklinefileName,
                                     srs, ogr.wkbLineString)
     field_name = ogr.FieldDefn("Type", ogr.OFTString)